@@ -0,0 +1,151 @@
+// A viewer for deep zoom pyramids. Only the tiles that are visible at the
+// current zoom level are downloaded. See `state.zoom_levels` for the
+// layout of the pyramid.
+const ESCAPE = 27;
+const MAX_SCALE = 2;
+const ZOOM_STEP = 1.5;
+
+const viewer = document.getElementById("zoom");
+const back = document.getElementById("back");
+
+const imageWidth = Number(viewer.dataset.width);
+const imageHeight = Number(viewer.dataset.height);
+const tileSize = Number(viewer.dataset.tileSize);
+const overlap = Number(viewer.dataset.overlap);
+const tilesUrl = viewer.dataset.tilesUrl;
+const maxLevel = Math.ceil(Math.log2(Math.max(imageWidth, imageHeight)));
+// The largest level that is a single tile is always shown below the
+// others, so there is something to look at while tiles load.
+const baseLevel = Math.min(maxLevel, maxLevel - Math.ceil(Math.log2(Math.max(imageWidth, imageHeight) / tileSize)));
+
+// Screen position = image position * scale + offset.
+let scale = 1;
+let offsetX = 0;
+let offsetY = 0;
+let minScale = 1;
+let renderQueued = false;
+const tiles = new Map();
+
+function levelSize(level) {
+  const levelScale = Math.pow(2, level - maxLevel);
+  return [Math.ceil(imageWidth * levelScale), Math.ceil(imageHeight * levelScale)];
+}
+
+function placeTile(level, column, row) {
+  const key = `${level}/${column}_${row}`;
+  let tile = tiles.get(key);
+  if (tile === undefined) {
+    tile = document.createElement("img");
+    tile.src = `${tilesUrl}${key}.jpg`;
+    tile.alt = "";
+    tile.style.zIndex = level;
+    tiles.set(key, tile);
+    viewer.appendChild(tile);
+  }
+
+  const [width, height] = levelSize(level);
+  const left = Math.max(0, column * tileSize - overlap);
+  const top = Math.max(0, row * tileSize - overlap);
+  const right = Math.min(width, (column + 1) * tileSize + overlap);
+  const bottom = Math.min(height, (row + 1) * tileSize + overlap);
+  const toScreen = scale * imageWidth / width;
+
+  tile.style.left = `${left * toScreen + offsetX}px`;
+  tile.style.top = `${top * toScreen + offsetY}px`;
+  tile.style.width = `${(right - left) * toScreen}px`;
+  tile.style.height = `${(bottom - top) * toScreen}px`;
+  return key;
+}
+
+function render() {
+  renderQueued = false;
+  const visible = new Set();
+  visible.add(placeTile(baseLevel, 0, 0));
+
+  // The smallest level that has at least one pixel per screen pixel.
+  const level = Math.min(maxLevel, Math.max(baseLevel, maxLevel + Math.ceil(Math.log2(scale))));
+  if (level > baseLevel) {
+    const [width, height] = levelSize(level);
+    const toLevel = width / imageWidth / scale;
+    const firstColumn = Math.max(0, Math.floor(-offsetX * toLevel / tileSize));
+    const firstRow = Math.max(0, Math.floor(-offsetY * toLevel / tileSize));
+    const lastColumn = Math.min(Math.ceil(width / tileSize), Math.ceil((viewer.clientWidth - offsetX) * toLevel / tileSize));
+    const lastRow = Math.min(Math.ceil(height / tileSize), Math.ceil((viewer.clientHeight - offsetY) * toLevel / tileSize));
+
+    for (let column = firstColumn; column < lastColumn; column++) {
+      for (let row = firstRow; row < lastRow; row++) {
+        visible.add(placeTile(level, column, row));
+      }
+    }
+  }
+
+  for (const [key, tile] of tiles) {
+    if (!visible.has(key)) {
+      tile.remove();
+      tiles.delete(key);
+    }
+  }
+}
+
+function queueRender() {
+  if (!renderQueued) {
+    renderQueued = true;
+    window.requestAnimationFrame(render);
+  }
+}
+
+function fit() {
+  minScale = Math.min(1, viewer.clientWidth / imageWidth, viewer.clientHeight / imageHeight);
+  scale = minScale;
+  offsetX = (viewer.clientWidth - imageWidth * scale) / 2;
+  offsetY = (viewer.clientHeight - imageHeight * scale) / 2;
+  queueRender();
+}
+
+// Zoom by `factor`, keeping the image position under (x, y) in place.
+function zoom(factor, x, y) {
+  const newScale = Math.min(MAX_SCALE, Math.max(minScale, scale * factor));
+  offsetX = x - (x - offsetX) * newScale / scale;
+  offsetY = y - (y - offsetY) * newScale / scale;
+  scale = newScale;
+  queueRender();
+}
+
+viewer.addEventListener("wheel", (ev) => {
+  ev.preventDefault();
+  zoom(ev.deltaY < 0 ? ZOOM_STEP : 1 / ZOOM_STEP, ev.offsetX, ev.offsetY);
+});
+
+viewer.addEventListener("dblclick", (ev) => {
+  zoom(ZOOM_STEP * ZOOM_STEP, ev.offsetX, ev.offsetY);
+});
+
+let dragging = null;
+viewer.addEventListener("pointerdown", (ev) => {
+  dragging = [ev.clientX, ev.clientY];
+  viewer.setPointerCapture(ev.pointerId);
+});
+viewer.addEventListener("pointermove", (ev) => {
+  if (dragging !== null) {
+    offsetX += ev.clientX - dragging[0];
+    offsetY += ev.clientY - dragging[1];
+    dragging = [ev.clientX, ev.clientY];
+    queueRender();
+  }
+});
+viewer.addEventListener("pointerup", () => { dragging = null; });
+viewer.addEventListener("pointercancel", () => { dragging = null; });
+
+document.getElementById("zoom-in").onclick = () => {
+  zoom(ZOOM_STEP, viewer.clientWidth / 2, viewer.clientHeight / 2);
+};
+document.getElementById("zoom-out").onclick = () => {
+  zoom(1 / ZOOM_STEP, viewer.clientWidth / 2, viewer.clientHeight / 2);
+};
+
+document.onkeyup = (ev) => {
+  if (ev.keyCode == ESCAPE && back != null) { back.click(); }
+};
+
+window.addEventListener("resize", fit);
+fit();
@@ -0,0 +1,69 @@
+"""
+A local copy of the state objects in the bucket.
+
+Every object is stored with its ETag, so it can be revalidated with a
+conditional GET instead of downloaded again. It also lets `pxl build` work
+from the last known state without a connection.
+"""
+
+import os
+
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+import pxl.config as config
+
+CACHE_DIR = config.PXL_DIR / Path("cache")
+
+
+@dataclass
+class CachedObject:
+    etag: str
+    contents: bytes
+
+
+def load(cfg: config.Config, object_name: str) -> Optional[CachedObject]:
+    path = _path_for(cfg, object_name)
+    try:
+        etag = _etag_path(path).read_text()
+        contents = path.read_bytes()
+    except FileNotFoundError:
+        return None
+
+    return CachedObject(etag=etag, contents=contents)
+
+
+def save(cfg: config.Config, object_name: str, etag: str, contents: bytes) -> None:
+    path = _path_for(cfg, object_name)
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    # Remove the ETag first, so a crash halfway never leaves an ETag that
+    # belongs to different contents.
+    remove(cfg, object_name)
+    _write_atomic(path, contents)
+    _write_atomic(_etag_path(path), etag.encode())
+
+
+def remove(cfg: config.Config, object_name: str) -> None:
+    path = _path_for(cfg, object_name)
+    for stale in [_etag_path(path), path]:
+        try:
+            stale.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def _path_for(cfg: config.Config, object_name: str) -> Path:
+    # Object names may contain slashes, those become directories.
+    return CACHE_DIR / cfg.s3_endpoint / cfg.s3_bucket / object_name
+
+
+def _etag_path(path: Path) -> Path:
+    return path.with_name(path.name + ".etag")
+
+
+def _write_atomic(path: Path, contents: bytes) -> None:
+    tmp_path = path.with_name(path.name + ".tmp")
+    tmp_path.write_bytes(contents)
+    os.replace(tmp_path, path)
@@ -6,6 +6,7 @@ import functools
 import getpass
 import http.server
 import json
+import os
 import socketserver
 import subprocess
 import sys
@@ -13,11 +14,15 @@ import copy
 
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Callable, List, Optional, Any
+from typing import Callable, Dict, List, Optional, Any
 
+import pxl.compress as compress
 import pxl.config as config
+import pxl.deploy as deploy
 import pxl.generate as generate
+import pxl.journal as journal
 import pxl.state as state
+import pxl.store as store
 import pxl.upload as upload
 
 entrypoint = Path(entrypoint_file).parent.absolute()
@@ -26,6 +31,9 @@ if entrypoint.match("/usr/*"):
 else:
     build_path = Path("ignore/build")
 
+# The number of uploaded images after which `pxl upload` saves the state.
+CHECKPOINT_INTERVAL = 100
+
 
 def validate(value: str) -> Optional[Any]:
     try:
@@ -98,21 +106,18 @@ def edit_cmd(album_name: str, force: bool) -> None:
     cfg = config.load()
     with upload.client(cfg, break_lock=force) as client:
         try:
-            pxl_state_json = upload.get_json(client, "state.json")
-            pxl_state = state.Overview.from_json(pxl_state_json)
-            assert pxl_state is not None, "Expected state to be valid"
-        except client.boto.exceptions.NoSuchKey as e:
-            pxl_state = state.Overview.empty()
+            index = store.load_index(client)
         except Exception as e:
             print(e)
             sys.exit(1)
 
-        print(pxl_state)
-        old_album = pxl_state.get_album_by_name(album_name)
-        if not (old_album):
+        print(index)
+        old_entry = index.get_album_by_name(album_name)
+        if not (old_entry):
             click.echo(f"{album_name} does not exist", err=True)
             sys.exit(1)
         else:
+            old_album = store.load_album(client, old_entry)
             new_album = copy.deepcopy(old_album)
             album_name = click.prompt(
                 "What should the new album name be?", default=old_album.name_display
@@ -123,37 +128,66 @@ def edit_cmd(album_name: str, force: bool) -> None:
                 value_proc=validate,
             )
 
-            alt_album = pxl_state.get_album_by_name(album_name)
-            if alt_album and not (album_name == old_album.name_display):
+            alt_entry = index.get_album_by_name(album_name)
+            if alt_entry and not (album_name == old_album.name_display):
                 click.confirm(
                     "An album with that name already exists. Merge albums?", abort=True
                 )
+                alt_album = store.load_album(client, alt_entry)
                 alt_album.created = album_date
                 alt_album.images = alt_album.images + old_album.images
-                pxl_state = pxl_state.remove_album(old_album)
-                pxl_state = pxl_state.edit_album(alt_album, alt_album)
-                upload.private_json(
-                    client, json.dumps(pxl_state.to_json()), "state.json"
-                )
+                new_alt_entry = store.save_album(client, alt_entry, alt_album)
+                index = index.remove_album(old_entry)
+                index = index.edit_album(alt_entry, new_alt_entry)
+                store.save_index(client, index)
+                store.delete_album(client, old_entry)
             else:
                 new_album.name_display = album_name
                 new_album.name_nav = album_name.lower().replace(" ", "-")
                 new_album.created = album_date
 
-                pxl_state = pxl_state.edit_album(old_album, new_album)
-                upload.private_json(
-                    client, json.dumps(pxl_state.to_json()), "state.json"
-                )
+                new_entry = store.save_album(client, old_entry, new_album)
+                index = index.edit_album(old_entry, new_entry)
+                store.save_index(client, index)
 
 
 @cli.command(name="upload")
 @click.argument("dir_name")
 @click.option("--force", is_flag=True, type=bool, help="Force break lock")
-def upload_cmd(dir_name: str, force: bool) -> None:
+@click.option(
+    "--jobs",
+    "-j",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Number of images to process in parallel (default: CPU count)",
+)
+@click.option(
+    "--resume", is_flag=True, type=bool, help="Continue an interrupted upload"
+)
+@click.option(
+    "--measure-savings",
+    is_flag=True,
+    type=bool,
+    help="Report the bytes saved compared to Pillow's defaults (slower)",
+)
+def upload_cmd(
+    dir_name: str, force: bool, jobs: Optional[int], resume: bool, measure_savings: bool
+) -> None:
     """
     Upload a directory to the photo hosting.
     """
     cfg = config.load()
+    jobs = jobs or os.cpu_count() or 1
+
+    try:
+        settings, unsupported = compress.settings_for_config(cfg)
+    except ValueError as e:
+        click.echo(e, err=True)
+        sys.exit(1)
+    settings.measure_baseline = measure_savings
+
+    for name in unsupported:
+        click.echo(f"Pillow can't encode {name} here, skipping it.", err=True)
 
     dir_path = Path(dir_name)
     if not dir_path.is_dir():
@@ -164,33 +198,53 @@ def upload_cmd(dir_name: str, force: bool) -> None:
         click.echo(f"{dir_path} is an empty folder.", err=True)
         sys.exit(1)
 
+    journal_path = journal.path_for(cfg, dir_path)
+    interrupted = journal.Journal.load(journal_path)
+    if interrupted and not resume:
+        click.echo(f"An earlier upload of {dir_path} was interrupted.", err=True)
+        click.echo("Pass --resume to continue it, or remove", err=True)
+        click.echo(f"{journal_path} to start over.", err=True)
+        sys.exit(1)
+
+    if resume and not interrupted:
+        click.echo(f"There is no interrupted upload of {dir_path}.", err=True)
+        sys.exit(1)
+
     with upload.client(cfg, break_lock=force) as client:
-        album_name = click.prompt(
-            "What name should the album have?", default=dir_path.name.title()
-        )
+        if interrupted:
+            album_name = interrupted.album_name
+            click.echo(f"Resuming upload to {album_name}.", err=True)
+        else:
+            album_name = click.prompt(
+                "What name should the album have?", default=dir_path.name.title()
+            )
 
         try:
-            pxl_state_json = upload.get_json(client, "state.json")
-            pxl_state = state.Overview.from_json(pxl_state_json)
-            assert pxl_state is not None, "Expected state to be valid"
-        except client.boto.exceptions.NoSuchKey as e:
-            pxl_state = state.Overview.empty()
+            index = store.load_index(client)
         except Exception as e:
             print(e)
             sys.exit(1)
 
-        print(pxl_state)
+        print(index)
 
-        # Get existing album with this name for appending.
-        album = pxl_state.get_album_by_name(album_name)
-        if album:
-            click.confirm("Album already exists. Add to existing album?", abort=True)
+        # Get existing album with this name for appending. When resuming,
+        # it may exist because of a checkpoint of the interrupted upload.
+        album_entry = index.get_album_by_name(album_name)
+        if album_entry:
+            album = store.load_album(client, album_entry)
+            if not interrupted:
+                click.confirm(
+                    "Album already exists. Add to existing album?", abort=True
+                )
         else:
-            date = click.prompt(  # type: ignore
-                "What date was the album created?",
-                default=datetime.datetime.now(),
-                value_proc=validate,
-            )
+            if interrupted:
+                date = interrupted.created
+            else:
+                date = click.prompt(  # type: ignore
+                    "What date was the album created?",
+                    default=datetime.datetime.now(),
+                    value_proc=validate,
+                )
 
             click.echo("Creating new album.", err=True)
             album = state.Album(
@@ -199,27 +253,114 @@ def upload_cmd(dir_name: str, force: bool) -> None:
                 created=date,
                 images=[],
             )
+            album_entry = state.AlbumEntry.for_album(album)
 
-        # Find all files with known JPEG extensions. We don't
-        # traverse nested directories, just the toplevel.
-        for entry in dir_path.iterdir():
-            if not entry.is_file():
-                continue
+        upload_journal = interrupted or journal.Journal.start(journal_path, album)
 
-            if not entry.suffix.lower() in [".jpeg", ".jpg"]:
+        # Find all files with known JPEG extensions. We don't
+        # traverse nested directories, just the toplevel. Sort them so
+        # the album order doesn't depend on the filesystem.
+        entries = [
+            entry
+            for entry in sorted(dir_path.iterdir())
+            if entry.is_file() and entry.suffix.lower() in [".jpeg", ".jpg"]
+        ]
+
+        # Files that were uploaded before, to any album, are not uploaded
+        # again. We reference the existing objects instead. Hashing is
+        # mostly I/O, so it runs on the client's thread pool. Images in
+        # the journal were uploaded before as well, we don't need to hash
+        # them again.
+        def hash_entry(entry: Path) -> str:
+            journaled = upload_journal.images.get(entry.name)
+            if journaled is not None and journaled.content_hash is not None:
+                return journaled.content_hash
+            return upload.content_hash(entry)
+
+        content_hashes = list(client.pool.map(hash_entry, entries))
+        content = store.load_content(client, content_hashes)
+
+        content_index: Dict[str, Optional[state.Image]] = {
+            content_hash: content_entry.image
+            for content_hash, content_entry in content.entries.items()
+        }
+        for journaled in upload_journal.images.values():
+            if journaled.content_hash is not None:
+                content_index[journaled.content_hash] = journaled
+
+        # Hashes of files in this batch map to None until they're uploaded.
+        new_entries = []
+        for entry, content_hash in zip(entries, content_hashes):
+            if content_hash not in content_index:
+                new_entries.append(entry)
+                content_index[content_hash] = None
+
+        # Images are compressed in worker processes and uploaded on the
+        # client's transfer pool. They are journaled as soon as they are
+        # uploaded, so an interruption doesn't lose any of them, but added
+        # to the album from here, in the order of `entries`.
+        hashes_by_entry = dict(zip(entries, content_hashes))
+
+        def record(entry: Path, image: state.Image) -> None:
+            image.content_hash = hashes_by_entry[entry]
+            upload_journal.record(entry, image)
+
+        stats = compress.EncodingStats()
+        compressed = stats.track(compress.compress_images(new_entries, settings, jobs))
+        uploaded = upload.public_compressed_images(client, compressed, record)
+
+        album_uuids = {image.remote_uuid for image in album.images}
+        uploads_since_checkpoint = 0
+        for entry, content_hash in zip(entries, content_hashes):
+            image = content_index[content_hash]
+            if image is None:
+                image = next(uploaded)
+                content_index[content_hash] = image
+                uploads_since_checkpoint += 1
+            elif image.remote_uuid in album_uuids:
+                click.echo(f"Skipping {entry}, it is already in the album.")
                 continue
+            else:
+                click.echo(f"Skipping upload of {entry}, it was uploaded before.")
 
-            image = upload.public_image_with_size(client, entry)
+            album_uuids.add(image.remote_uuid)
             album = album.add_image(image)
+            content.add_ref(image)
 
-        pxl_state = pxl_state.add_or_replace_album(album)
-        upload.private_json(client, json.dumps(pxl_state.to_json()), "state.json")
+            # Save the progress to the remote state every now and then,
+            # so an interruption doesn't leave a lot of orphaned objects.
+            if uploads_since_checkpoint >= CHECKPOINT_INTERVAL:
+                album_entry = store.save_album(client, album_entry, album)
+                index = index.add_or_replace_album(album_entry)
+                store.save_index(client, index)
+                store.save_content(client, content)
+                uploads_since_checkpoint = 0
+
+        album_entry = store.save_album(client, album_entry, album)
+        index = index.add_or_replace_album(album_entry)
+        store.save_index(client, index)
+        store.save_content(client, content)
+        upload_journal.remove()
+
+        if stats.images:
+            click.echo(stats.summary())
 
 
 @cli.command("build")
 @click.option("--force", is_flag=True, type=bool, help="Force break lock")
-def build_cmd(force: bool) -> None:
+@click.option(
+    "--offline", is_flag=True, type=bool, help="Build from the locally cached state"
+)
+@click.option(
+    "--jobs",
+    "-j",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Number of albums to render in parallel (default: CPU count)",
+)
+def build_cmd(force: bool, offline: bool, jobs: Optional[int]) -> None:
     """Build a static site based on current state."""
+    jobs = jobs or os.cpu_count() or 1
     output_dir = build_path
     output_dir.mkdir(parents=True, exist_ok=True)
 
@@ -227,30 +368,48 @@ def build_cmd(force: bool) -> None:
     design_dir = Path(entrypoint) / "design"
 
     cfg = config.load()
-    with upload.client(cfg, break_lock=force) as client:
-        try:
-            pxl_state_json = upload.get_json(client, "state.json")
-            overview = state.Overview.from_json(pxl_state_json)
-            assert overview is not None, "Expected state to be valid"
-        except client.boto.exceptions.NoSuchKey as e:
+    if offline:
+        cached_overview = store.load_cached_overview(cfg)
+        if cached_overview is None:
             click.echo(
-                "Remote state not found. Please upload before continuing.", err=True
+                "No cached state found. Please build without --offline first.", err=True
             )
             sys.exit(1)
-        except Exception as e:
-            click.echo(e, err=True)
+        overview = cached_overview
+    else:
+        with upload.client(cfg, break_lock=force) as client:
+            try:
+                remote_overview = store.load_overview(client)
+            except Exception as e:
+                click.echo(e, err=True)
+                sys.exit(1)
+
+        # An index without albums is fine, it's left after deleting the
+        # last album, and builds an empty site.
+        if remote_overview is None:
+            click.echo(
+                "Remote state not found. Please upload before continuing.", err=True
+            )
             sys.exit(1)
-
-        bucket_puburl = f"https://{cfg.s3_bucket}.{cfg.s3_region}.{cfg.s3_endpoint}"
-
-        generate.build(
-            overview=overview,
-            output_dir=output_dir,
-            template_dir=design_dir,
-            bucket_puburl=bucket_puburl,
-            public_image_url=cfg.public_image_url,
-        )
-    click.echo("Done.", err=True)
+        overview = remote_overview
+
+    bucket_puburl = f"https://{cfg.s3_bucket}.{cfg.s3_region}.{cfg.s3_endpoint}"
+
+    result = generate.build(
+        overview=overview,
+        output_dir=output_dir,
+        template_dir=design_dir,
+        bucket_puburl=bucket_puburl,
+        public_image_url=cfg.public_image_url,
+        album_page_size=cfg.album_page_size,
+        inline_css=cfg.inline_css,
+        jobs=jobs,
+    )
+    click.echo(
+        f"Done. Wrote {result.written} files, {result.unchanged} were unchanged "
+        f"and {result.deleted} were deleted.",
+        err=True,
+    )
 
 
 @cli.command("preview")
@@ -285,7 +444,19 @@ def preview_cmd(port: int, bind: str) -> None:
 
 
 @cli.command("deploy")
-def deploy_cmd() -> None:
+@click.option(
+    "--delta",
+    is_flag=True,
+    type=bool,
+    help="Only send the files that changed since the last deploy",
+)
+@click.option(
+    "--bucket",
+    is_flag=True,
+    type=bool,
+    help="Upload the site to the configured site_bucket",
+)
+def deploy_cmd(delta: bool, bucket: bool) -> None:
     """Deploy the static output."""
     if not config.is_initialized():
         click.echo("Config not initialized. Please run `pxl init` first.", err=False)
@@ -296,8 +467,20 @@ def deploy_cmd() -> None:
         click.echo("No output to deploy. Please run `pxl build` first.", err=False)
         sys.exit(1)
 
+    if delta and bucket:
+        click.echo("--delta and --bucket can't be used together.", err=True)
+        sys.exit(1)
+
     cfg = config.load()
 
+    if bucket:
+        deploy_bucket(output_dir, cfg)
+        return
+
+    if delta:
+        deploy_delta(output_dir, cfg)
+        return
+
     dry_run_result = subprocess.run(
         build_deploy_rsync(output_dir, cfg, dry_run=True),
         capture_output=True,
@@ -325,6 +508,113 @@ def deploy_cmd() -> None:
     dry_run_result = subprocess.run(build_deploy_rsync(output_dir, cfg, dry_run=False))
 
 
+def deploy_delta(output_dir: Path, cfg: config.Config) -> None:
+    """
+    Deploy by comparing the build manifest with the one of the last deploy,
+    instead of comparing every file with rsync.
+    """
+    local_manifest = generate.Manifest.load(output_dir)
+    if local_manifest is None:
+        click.echo("No build manifest found. Please run `pxl build` first.")
+        sys.exit(1)
+
+    try:
+        deploy.RemotePaths.for_config(cfg)
+    except ValueError as e:
+        click.echo(e, err=True)
+        sys.exit(1)
+
+    try:
+        remote_manifest = deploy.load_remote_manifest(cfg)
+    except subprocess.CalledProcessError as e:
+        click.echo(f"Couldn't load the manifest of the last deploy: {e}", err=True)
+        sys.exit(1)
+
+    if remote_manifest is None:
+        click.echo(
+            "The server has no manifest of an earlier deploy, sending everything."
+        )
+
+    delta = deploy.Delta.between(local_manifest, remote_manifest)
+    if not delta.upload and not delta.delete:
+        click.echo("Nothing changed since the last deploy.")
+        return
+
+    if delta.delete:
+        click.echo(
+            click.style("Warning! This deploy will delete these files:", fg="yellow")
+        )
+        for relpath in delta.delete:
+            click.echo(click.style(relpath, fg="yellow"))
+
+        if not click.confirm("Continue?"):
+            click.echo("Aborting.")
+            return
+
+    click.echo(f"Sending {len(delta.upload)} files and deleting {len(delta.delete)}.")
+    try:
+        deploy.deploy(output_dir, cfg, delta)
+    except subprocess.CalledProcessError as e:
+        # The manifest is only replaced once everything else arrived, so the
+        # next deploy sends the same files again.
+        click.echo(f"Deploy failed: {e}", err=True)
+        sys.exit(1)
+
+
+def deploy_bucket(output_dir: Path, cfg: config.Config) -> None:
+    """
+    Deploy to a bucket, uploading the files whose contents differ from
+    their objects.
+    """
+    if not cfg.site_bucket:
+        click.echo("No site_bucket configured. Please see the deployment docs.")
+        sys.exit(1)
+
+    # Every object in the site bucket that isn't part of the site is
+    # deleted, which would include all photos and the state.
+    if cfg.site_bucket == cfg.s3_bucket:
+        click.echo(
+            "site_bucket must not be the bucket the photos are uploaded to.", err=True
+        )
+        sys.exit(1)
+
+    manifest = generate.Manifest.load(output_dir)
+    if manifest is None:
+        click.echo("No build manifest found. Please run `pxl build` first.")
+        sys.exit(1)
+
+    # The site bucket has nothing to do with the state, so don't lock it.
+    with upload.client(cfg, lock=False) as client:
+        objects = deploy.site_objects(output_dir, manifest)
+        delta = deploy.bucket_delta(client, cfg.site_bucket, objects)
+        if not delta.upload and not delta.delete:
+            click.echo("Nothing changed since the last deploy.")
+            return
+
+        if delta.delete:
+            click.echo(
+                click.style(
+                    f"Warning! This deploy will delete these objects from {cfg.site_bucket}:",
+                    fg="yellow",
+                )
+            )
+            for key in delta.delete:
+                click.echo(click.style(key, fg="yellow"))
+
+            if not click.confirm("Continue?"):
+                click.echo("Aborting.")
+                return
+
+        click.echo(
+            f"Uploading {len(delta.upload)} objects and deleting {len(delta.delete)}."
+        )
+        try:
+            deploy.deploy_to_bucket(client, cfg.site_bucket, delta)
+        except RuntimeError as e:
+            click.echo(e, err=True)
+            sys.exit(1)
+
+
 def build_deploy_rsync(
     output_dir: Path, cfg: config.Config, dry_run: bool = False
 ) -> List[str]:
@@ -339,9 +629,13 @@ def build_deploy_rsync(
     result = [
         "rsync",
         "--recursive",
+        # The build leaves unchanged files alone, so their mtimes tell rsync
+        # what it can skip.
+        "--times",
         "--compress",
         "--partial",
         "--delete",
+        f"--exclude=/{generate.MANIFEST_NAME}",
         f"{output_dir}/",
         f"{cfg.deploy_user}@{cfg.deploy_host}:{cfg.deploy_path}",
     ]
@@ -368,34 +662,49 @@ def delete_cmd(album_name: str, force: bool) -> None:
     with upload.client(cfg, break_lock=force) as client:
 
         try:
-            pxl_state_json = upload.get_json(client, "state.json")
-            pxl_state = state.Overview.from_json(pxl_state_json)
-            assert pxl_state is not None, "Expected state to be valid"
-        except client.boto.exceptions.NoSuchKey as e:
-            pxl_state = state.Overview.empty()
+            index = store.load_index(client)
         except Exception as e:
             print(e)
             sys.exit(1)
 
-        print(pxl_state)
+        print(index)
 
         # Get existing album with this name to check if it exists
-        album = pxl_state.get_album_by_name(album_name)
-        if album:
+        entry = index.get_album_by_name(album_name)
+        if entry:
             click.echo("Album found, deleting pictures...")
+            album = store.load_album(client, entry)
+            content = store.load_content(
+                client,
+                [image.content_hash for image in album.images if image.content_hash],
+            )
+            object_names = []
             for image in album.images:
-                upload.delete_image(client, image.get_name("original"))
-                upload.delete_image(client, image.get_name("display_w_1600"))
-                upload.delete_image(client, image.get_name("thumbnail_w_400"))
+                # Deduplicated images may still be used by another album.
+                if content.remove_ref(image):
+                    object_names += image.get_object_names()
 
         else:
             click.echo("Given album not found")
             sys.exit(1)
 
+        errors = upload.delete_objects(client, cfg.s3_bucket, object_names)
+        if errors:
+            # Leave the state alone, so running this again retries. Objects
+            # that are gone already don't cause errors.
+            click.echo(f"Couldn't delete {len(errors)} objects:", err=True)
+            for object_name, error in errors.items():
+                click.echo(f"{object_name}: {error}", err=True)
+            sys.exit(1)
+
+        click.echo(f"deleted {len(object_names)} objects")
+
         click.echo("deleting album...")
 
-        pxl_state = pxl_state.remove_album(album)
-        upload.private_json(client, json.dumps(pxl_state.to_json()), "state.json")
+        index = index.remove_album(entry)
+        store.save_index(client, index)
+        store.save_content(client, content)
+        store.delete_album(client, entry)
 
         click.echo("deleted album, please run build and deploy now")
 
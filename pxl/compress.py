@@ -1,72 +1,709 @@
-import tempfile
+import collections
+import concurrent.futures
+import math
 import pathlib
+import shutil
+import struct
+import io
+import subprocess
 
-from typing import Any, Dict
+from dataclasses import dataclass
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional, Tuple, Union
 
-from PIL import Image  # type: ignore
+from PIL import Image, ImageChops, ImageStat, features  # type: ignore
 
-from pxl import state
+from pxl import config, state
 
+try:
+    from PIL import ImageCms  # type: ignore
+except ImportError:
+    # Pillow can be built without LittleCMS.
+    ImageCms = None  # type: ignore
 
-def compress_image(local_filename: pathlib.Path) -> Dict[state.Size, pathlib.Path]:
+# The contents of every size of an image. Either a file that is uploaded
+# as it is, or an encoded image in memory.
+Contents = Union[pathlib.Path, bytes]
+
+
+@dataclass
+class CompressedImage:
+    # The JPEG contents of every size.
+    contents: Dict[state.Size, Contents]
+    # The scaled versions in other formats.
+    alternates: Dict[Tuple[state.Size, state.Format], bytes]
+    # Dimensions of the original, upright.
+    width: int
+    height: int
+    # The total size of the scaled JPEGs, and what it would have been with
+    # Pillow's default settings, if that was measured.
+    encoded_bytes: int
+    baseline_bytes: int
+    # The bytes saved by leaving out the metadata of the original, and by
+    # the quality search compared to the qualities of the profiles.
+    metadata_bytes: int
+    searched_bytes: int
+    # A PNG of at most `PLACEHOLDER_SIZE` pixels wide and high.
+    placeholder: bytes
+    # The deep zoom pyramid, if the image got one. The keys are appended
+    # to `state.Image.get_tiles_name()` to get the object names.
+    tiles: Dict[str, bytes]
+    tile_size: Optional[int]
+
+
+@dataclass
+class EncoderProfile:
+    quality: int
+    # Progressive JPEGs are usually a bit smaller, and show a preview of
+    # the whole image while loading.
+    progressive: bool = True
+    # Compute optimal Huffman tables instead of using the standard ones.
+    # This is lossless.
+    optimize: bool = True
+
+
+@dataclass
+class QualityBudget:
+    """
+    Targets for the quality search. The scaled JPEGs get the lowest
+    quality that still reaches `min_psnr`, but never more bytes than
+    `max_bytes_per_megapixel` allows.
+    """
+
+    max_bytes_per_megapixel: Optional[int]
+    min_psnr: Optional[float]
+
+
+@dataclass
+class Settings:
+    # Ordered from large to small, see `sizes_for_widths`.
+    sizes: List[state.Size]
+    # The formats besides JPEG, see `formats_for_names`.
+    formats: List[state.Format]
+    budget: Optional[QualityBudget]
+    # Images with at least this many pixels get a deep zoom pyramid.
+    deep_zoom_min_pixels: Optional[int]
+    # Encode every scaled JPEG with Pillow's defaults too, to measure how
+    # many bytes the profiles save. That's another full encode per size.
+    measure_baseline: bool = False
+
+
+@dataclass
+class EncodingStats:
+    """
+    Keeps track of how many bytes the scaled JPEGs take, and how many were
+    saved. The savings compared to Pillow's defaults are only known if
+    `Settings.measure_baseline` is set.
+    """
+
+    images: int = 0
+    encoded_bytes: int = 0
+    baseline_bytes: int = 0
+    metadata_bytes: int = 0
+    searched_bytes: int = 0
+
+    def track(
+        self, compressed: Iterator[Tuple[pathlib.Path, CompressedImage]]
+    ) -> Iterator[Tuple[pathlib.Path, CompressedImage]]:
+        for local_filename, compressed_image in compressed:
+            self.images += 1
+            self.encoded_bytes += compressed_image.encoded_bytes
+            self.baseline_bytes += compressed_image.baseline_bytes
+            self.metadata_bytes += compressed_image.metadata_bytes
+            self.searched_bytes += compressed_image.searched_bytes
+            yield local_filename, compressed_image
+
+    def summary(self) -> str:
+        lines = [
+            f"Scaled JPEGs of {self.images} images take {self.encoded_bytes:,} bytes.",
+            f"Leaving out metadata saved {self.metadata_bytes:,} bytes.",
+        ]
+        if self.searched_bytes:
+            lines.append(f"The quality search saved {self.searched_bytes:,} bytes.")
+        if self.baseline_bytes:
+            saved = self.baseline_bytes - self.encoded_bytes
+            percentage = 100 * saved / self.baseline_bytes
+            lines.append(
+                f"That's {saved:,} bytes ({percentage:.1f}%) less than with "
+                "default settings."
+            )
+        return "\n".join(lines)
+
+
+# The re-encoded originals get Pillow's default quality, like before, but
+# the lossless size optimization doesn't hurt.
+ORIGINAL_PROFILE = EncoderProfile(quality=75, progressive=False)
+DISPLAY_PROFILE = EncoderProfile(quality=75)
+# Thumbnails are shown small, and there are a lot of them on every page.
+THUMBNAIL_PROFILE = EncoderProfile(quality=70)
+THUMBNAIL_MAX_WIDTH = 400
+
+# The lowest quality the quality search will go to.
+MIN_SEARCH_QUALITY = 40
+
+# The tile size most deep zoom viewers default to. With the overlap on
+# both sides, most tiles are 256 pixels wide.
+TILE_SIZE = 254
+# Tiles are small, so progressive encoding doesn't help.
+TILE_PROFILE = EncoderProfile(quality=75, progressive=False)
+
+# Placeholders are inlined in the pages, so they have to be tiny. Browsers
+# blur them when scaling them up, which is all we need.
+PLACEHOLDER_SIZE = 8
+
+
+# Encoder settings for the other formats, chosen to look like the JPEGs
+# at a fraction of the size. A higher AVIF speed trades a few percent of
+# size for encoding several times faster.
+ENCODER_OPTIONS: Dict[state.Format, Dict[str, Any]] = {
+    state.Format.webp: {"quality": 80},
+    state.Format.avif: {"quality": 50, "speed": 8},
+}
+
+# EXIF metadata is a binary format. The magic number below stands for
+# the part of the metadata which all compliant software uses as the
+# orientation tag. The parsed EXIF data is a dict from magic numbers to
+# binary data. We need to use this number to get the orientation number,
+# which is another magic number.
+ORIENTATION_TAG = 274
+
+# The `jpegtran` arguments that losslessly undo each EXIF orientation.
+# See http://sylvana.net/jpegcrop/exif_orientation.html
+JPEGTRAN_TRANSFORMS: Dict[int, List[str]] = {
+    2: ["-flip", "horizontal"],
+    3: ["-rotate", "180"],
+    4: ["-flip", "vertical"],
+    5: ["-transpose"],
+    6: ["-rotate", "90"],
+    7: ["-transverse"],
+    8: ["-rotate", "270"],
+}
+
+# How much larger than the target size an image must stay before the
+# final, expensive, resize step. See `scale_to`.
+REDUCING_GAP = 3
+
+
+def sizes_for_widths(widths: List[int]) -> List[state.Size]:
     """
-    Compresses the image to different sizes.
-    Returns a Dict of `state.Size`s to `Path`s in a temporary directory.
+    Get the sizes to generate for the configured derivative widths, in the
+    order `compress_image` expects them. Raises `ValueError` for widths
+    that don't have a `state.Size`.
     """
-    sizes_to_generate = [state.Size.thumbnail_w_400, state.Size.display_w_1600]
-    image_paths: Dict[state.Size, pathlib.Path] = {}
-    tempdir = pathlib.Path(tempfile.gettempdir())
+    sizes = []
+    for width in sorted(set(widths), reverse=True):
+        size = state.Size.for_width(width)
+        if size is None:
+            supported = sorted(
+                s.max_width for s in state.Size if s != state.Size.original
+            )
+            raise ValueError(
+                f"Unsupported derivative width {width}, choose from {supported}"
+            )
+        sizes.append(size)
+    return sizes
+
+
+def formats_for_names(names: List[str]) -> Tuple[List[state.Format], List[str]]:
+    """
+    Get the formats besides JPEG to encode scaled versions in, for the
+    configured format names. Raises `ValueError` for unknown formats.
+    Returns the formats and the names of those that this installation of
+    Pillow can't encode, those are left out.
+    """
+    formats: List[state.Format] = []
+    unsupported = []
+    for name in names:
+        if name not in state.Format.__members__:
+            raise ValueError(f"Unknown derivative format {name}")
+
+        format = state.Format[name]
+        if format == state.Format.jpeg or format in formats:
+            continue
 
+        if format_supported(format):
+            formats.append(format)
+        else:
+            unsupported.append(name)
+    return formats, unsupported
+
+
+def settings_for_config(cfg: config.Config) -> Tuple[Settings, List[str]]:
+    """
+    Get the compression settings from the config. Raises `ValueError` for
+    invalid sizes or formats. Also returns the names of the formats that
+    are left out, see `formats_for_names`.
+    """
+    formats, unsupported = formats_for_names(cfg.derivative_formats)
+    budget = None
+    if cfg.jpeg_max_bytes_per_megapixel is not None or cfg.jpeg_min_psnr is not None:
+        budget = QualityBudget(
+            max_bytes_per_megapixel=cfg.jpeg_max_bytes_per_megapixel,
+            min_psnr=cfg.jpeg_min_psnr,
+        )
+    deep_zoom_min_pixels = None
+    if cfg.deep_zoom_min_megapixels is not None:
+        deep_zoom_min_pixels = round(cfg.deep_zoom_min_megapixels * 1_000_000)
+    settings = Settings(
+        sizes=sizes_for_widths(cfg.derivative_widths),
+        formats=formats,
+        budget=budget,
+        deep_zoom_min_pixels=deep_zoom_min_pixels,
+    )
+    return settings, unsupported
+
+
+def format_supported(format: state.Format) -> bool:
+    try:
+        return bool(features.check(format.name))
+    except ValueError:
+        # Older versions of Pillow don't know the feature at all.
+        return False
+
+
+def profile_for(size: state.Size) -> EncoderProfile:
+    if size == state.Size.original:
+        return ORIGINAL_PROFILE
+    if size.max_width <= THUMBNAIL_MAX_WIDTH:
+        return THUMBNAIL_PROFILE
+    return DISPLAY_PROFILE
+
+
+def compress_images(
+    local_filenames: List[pathlib.Path], settings: Settings, jobs: int
+) -> Iterator[Tuple[pathlib.Path, CompressedImage]]:
+    """
+    Compresses a batch of images using `jobs` worker processes.
+    Yields `(local_filename, compress_image(local_filename, settings))`
+    pairs in the same order as `local_filenames`, so callers get a
+    deterministic album.
+    """
+    if jobs <= 1:
+        for local_filename in local_filenames:
+            yield local_filename, compress_image(local_filename, settings)
+        return
+
+    # Only keep a couple of images per worker in flight. Submitting the
+    # whole batch up front would let results pile up in the parent while
+    # it is still busy uploading earlier images.
+    window = jobs * 2
+    pending: Deque[Tuple[pathlib.Path, concurrent.futures.Future[CompressedImage]]] = (
+        collections.deque()
+    )
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        for local_filename in local_filenames:
+            future = pool.submit(compress_image, local_filename, settings)
+            pending.append((local_filename, future))
+
+            if len(pending) >= window:
+                done_filename, done_future = pending.popleft()
+                yield done_filename, done_future.result()
+
+        while pending:
+            done_filename, done_future = pending.popleft()
+            yield done_filename, done_future.result()
+
+
+def compress_image(local_filename: pathlib.Path, settings: Settings) -> CompressedImage:
+    """
+    Compresses the image to the original and every size in `settings`.
+    The scaled versions are also encoded in each of its formats, and carry
+    no metadata. Large images get a deep zoom pyramid as well.
+    Returns the contents of the original and the sizes in `settings`,
+    except those that would be copies of a smaller one because the source
+    isn't as wide as them. The original is either the source file itself,
+    or encoded in memory. All other sizes are encoded
+    in memory, so nothing is written to disk.
+    """
+    sizes = settings.sizes
+    image_contents: Dict[state.Size, Contents] = {}
+    alternates: Dict[Tuple[state.Size, state.Format], bytes] = {}
+    encoded_bytes = 0
+    baseline_bytes = 0
+    searched_bytes = 0
+    tiles: Dict[str, bytes] = {}
+    tile_size = None
+
+    # The source is only decoded once. Every size is scaled down from
+    # the next larger one, so the full resolution image is only resized
+    # once, no matter how many sizes we generate.
     with Image.open(local_filename, "r") as image:
-        image = orient_exif(image)
+        orientation = get_orientation(image)
+        # Every scaled JPEG would carry these if they were copied over.
+        metadata_size = len(image.info.get("exif") or b"") + len(
+            image.info.get("icc_profile") or b""
+        )
+        width, height = upright_size(image, orientation)
+        original = pass_through_original(local_filename, image, orientation)
+        deep_zoom = (
+            settings.deep_zoom_min_pixels is not None
+            and width * height >= settings.deep_zoom_min_pixels
+        )
 
-        original_tmp_path = tempdir / local_filename.name
+        if original is not None and sizes and not deep_zoom:
+            # We don't need the full resolution pixels for the original,
+            # so let the JPEG decoder scale down while decoding.
+            draft_for_width(image, sizes[0].max_width, width)
+
+        image = orient_exif(image)
+        # The scaled versions don't have an ICC profile, so browsers show
+        # them as sRGB.
+        image = convert_to_srgb(image)
         image = image.convert("RGB")
-        image.save(original_tmp_path)
-        image_paths[state.Size.original] = original_tmp_path
-
-        # Get the original dimensions
-        real_w, real_h = image.size
-        for size_to_generate in sizes_to_generate:
-            # Prevent upscaling
-            w = size_to_generate.max_width
-            if w >= real_w:
-                image_paths[size_to_generate] = original_tmp_path
-
-            # Copy original image
-            scaled = image.copy()
-            # Calculate scaling by preserving aspect ratio
-            size = w, real_h * (w / real_w)
-            # Scale the image
-            scaled.thumbnail(size, Image.ANTIALIAS)
-            # Save the image with a width specification
-            scaled_path = pathlib.Path(tempfile.gettempdir()).joinpath(
-                f"{local_filename.stem}-w{size[0]}.jpeg"
+
+        if original is None:
+            original = encode_jpeg(image, ORIGINAL_PROFILE)
+        image_contents[state.Size.original] = original
+
+        if deep_zoom:
+            tiles = encode_tiles(image, TILE_SIZE)
+            tile_size = TILE_SIZE
+
+        # Sizes at least as wide as the source would all be copies of it,
+        # so only the smallest of them is stored. `Image.closest_size`
+        # picks it for the others.
+        oversized = [size for size in sizes if size.max_width >= width]
+        scaled = [size for size in sizes if size.max_width < width]
+        for size_to_generate in oversized[-1:] + scaled:
+            # The drafted image may already have the right size.
+            target = state.scaled_size(width, height, size_to_generate.max_width)
+            if image.size != target:
+                image = scale_to(image, target)
+            profile = profile_for(size_to_generate)
+            if settings.budget is not None:
+                contents, unsearched = search_quality(image, profile, settings.budget)
+                searched_bytes += unsearched - len(contents)
+            else:
+                contents = encode_jpeg(image, profile)
+            image_contents[size_to_generate] = contents
+
+            encoded_bytes += len(contents)
+            if settings.measure_baseline:
+                baseline_bytes += len(encode_jpeg(image, None))
+
+            for format in settings.formats:
+                alternates[(size_to_generate, format)] = encode(image, format)
+
+    return CompressedImage(
+        contents=image_contents,
+        alternates=alternates,
+        width=width,
+        height=height,
+        encoded_bytes=encoded_bytes,
+        baseline_bytes=baseline_bytes,
+        metadata_bytes=metadata_size * len(oversized[-1:] + scaled),
+        searched_bytes=searched_bytes,
+        placeholder=encode_placeholder(image),
+        tiles=tiles,
+        tile_size=tile_size,
+    )
+
+
+def encode_tiles(image: Any, tile_size: int) -> Dict[str, bytes]:
+    """
+    Encode a deep zoom pyramid of the full resolution image: the DZI
+    descriptor, and the tiles of every level. See `state.zoom_levels`.
+    """
+    tiles = {".dzi": dzi_descriptor(image.width, image.height, tile_size)}
+    overlap = state.TILE_OVERLAP
+
+    level_image = image
+    for level in state.zoom_levels(image.width, image.height, tile_size):
+        # Every level is half the size of the one before it, so a box
+        # filter averages exactly the pixels that were merged.
+        if level_image.size != (level.width, level.height):
+            level_image = level_image.resize((level.width, level.height), Image.BOX)
+
+        for column in range(level.columns):
+            for row in range(level.rows):
+                box = (
+                    max(0, column * tile_size - overlap),
+                    max(0, row * tile_size - overlap),
+                    min(level.width, (column + 1) * tile_size + overlap),
+                    min(level.height, (row + 1) * tile_size + overlap),
+                )
+                tile_name = f"_files/{level.level}/{column}_{row}.jpg"
+                tiles[tile_name] = encode_jpeg(level_image.crop(box), TILE_PROFILE)
+
+    return tiles
+
+
+def dzi_descriptor(width: int, height: int, tile_size: int) -> bytes:
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" Format="jpg" '
+        f'Overlap="{state.TILE_OVERLAP}" TileSize="{tile_size}">'
+        f'<Size Width="{width}" Height="{height}"/>'
+        "</Image>\n"
+    ).encode()
+
+
+def encode_placeholder(image: Any) -> bytes:
+    """
+    Encode a tiny version of an image as PNG. `image` is the smallest
+    version we have, so this is cheap.
+    """
+    placeholder = image.copy()
+    placeholder.thumbnail((PLACEHOLDER_SIZE, PLACEHOLDER_SIZE), Image.LANCZOS)
+    buffer = io.BytesIO()
+    placeholder.save(buffer, "PNG", optimize=True)
+    return buffer.getvalue()
+
+
+def encode_jpeg(image: Any, profile: Optional[EncoderProfile]) -> bytes:
+    """
+    Encode an image as JPEG, without any metadata. Without a profile,
+    Pillow's defaults are used.
+    """
+    buffer = io.BytesIO()
+    if profile is None:
+        image.save(buffer, "JPEG")
+    else:
+        image.save(
+            buffer,
+            "JPEG",
+            quality=profile.quality,
+            progressive=profile.progressive,
+            optimize=profile.optimize,
+        )
+    return buffer.getvalue()
+
+
+def search_quality(
+    image: Any, profile: EncoderProfile, budget: QualityBudget
+) -> Tuple[bytes, int]:
+    """
+    Find the quality that meets the budget, between `MIN_SEARCH_QUALITY`
+    and the quality of `profile`. Both targets get better with a higher
+    quality, so this is a binary search. Returns the JPEG at that quality,
+    and the size of the one at the quality of `profile`.
+    """
+    encoded: Dict[int, bytes] = {}
+
+    def encode_with(quality: int) -> bytes:
+        if quality not in encoded:
+            encoded[quality] = encode_jpeg(
+                image,
+                EncoderProfile(
+                    quality=quality,
+                    progressive=profile.progressive,
+                    optimize=profile.optimize,
+                ),
             )
-            scaled.save(scaled_path, image.format)
+        return encoded[quality]
 
-            # Add the path to the output list
-            image_paths[size_to_generate] = scaled_path
+    def lowest_quality(acceptable: Callable[[int], bool]) -> Optional[int]:
+        low, high = MIN_SEARCH_QUALITY, profile.quality
+        if not acceptable(high):
+            return None
+        while low < high:
+            middle = (low + high) // 2
+            if acceptable(middle):
+                high = middle
+            else:
+                low = middle + 1
+        return low
 
-    return image_paths
+    quality = profile.quality
+    if budget.min_psnr is not None:
+        min_psnr = budget.min_psnr
+        lowest = lowest_quality(lambda q: psnr(image, encode_with(q)) >= min_psnr)
+        quality = lowest if lowest is not None else profile.quality
 
+    if budget.max_bytes_per_megapixel is not None:
+        max_bytes = budget.max_bytes_per_megapixel * image.width * image.height / 1e6
+        # The highest quality that fits is one below the lowest that doesn't.
+        too_big = lowest_quality(lambda q: len(encode_with(q)) > max_bytes)
+        if too_big is not None:
+            quality = min(quality, max(MIN_SEARCH_QUALITY, too_big - 1))
 
-def orient_exif(image: Any) -> Any:
+    return encode_with(quality), len(encode_with(profile.quality))
+
+
+def psnr(image: Any, jpeg: bytes) -> float:
     """
-    Rotate the image according to EXIF metadata.
+    The peak signal-to-noise ratio of a JPEG compared to the image it was
+    encoded from, in dB. Higher is closer to the image.
+    """
+    with Image.open(io.BytesIO(jpeg)) as decoded:
+        difference = ImageChops.difference(image, decoded.convert("RGB"))
+    squared_errors = [rms ** 2 for rms in ImageStat.Stat(difference).rms]
+    mean_squared_error = sum(squared_errors) / len(squared_errors)
+    if mean_squared_error == 0:
+        return math.inf
+    return 10 * math.log10(255 ** 2 / mean_squared_error)
+
+
+def convert_to_srgb(image: Any) -> Any:
+    """
+    Convert an image with an embedded ICC profile to sRGB. Images are
+    returned unchanged if they don't have a profile or if it can't be
+    applied.
+    """
+    icc_profile = image.info.get("icc_profile")
+    if not icc_profile or ImageCms is None:
+        return image
+
+    try:
+        source = ImageCms.ImageCmsProfile(io.BytesIO(icc_profile))
+        srgb = ImageCms.createProfile("sRGB")
+        return ImageCms.profileToProfile(image, source, srgb, outputMode="RGB")
+    except ImageCms.PyCMSError:
+        return image
+
+
+def encode(image: Any, format: state.Format) -> bytes:
+    """Encode a scaled version in one of the `ENCODER_OPTIONS` formats."""
+    buffer = io.BytesIO()
+    image.save(buffer, format.name.upper(), **ENCODER_OPTIONS[format])
+    return buffer.getvalue()
+
+
+def pass_through_original(
+    local_filename: pathlib.Path, image: Any, orientation: Optional[int]
+) -> Optional[Contents]:
+    """
+    Try to use the source file as the original without re-encoding it.
+
+    This works for JPEGs that browsers display correctly as they are.
+    JPEGs that need rotating are transformed losslessly with `jpegtran`,
+    if it is installed. Returns `None` if the original must be
+    re-encoded.
+    """
+    # Browsers don't handle CMYK JPEGs well, those need converting.
+    if image.format != "JPEG" or image.mode not in ["RGB", "L"]:
+        return None
+
+    if orientation is None or orientation == 1:
+        return local_filename
+
+    jpegtran = shutil.which("jpegtran")
+    if jpegtran is None or orientation not in JPEGTRAN_TRANSFORMS:
+        return None
+
+    # -perfect makes jpegtran fail instead of dropping the edge blocks
+    # when the dimensions aren't a multiple of the block size.
+    result = subprocess.run(
+        [jpegtran, "-copy", "all", "-perfect"]
+        + JPEGTRAN_TRANSFORMS[orientation]
+        + [str(local_filename)],
+        capture_output=True,
+    )
+    if result.returncode != 0:
+        return None
+
+    # The pixels are upright now, so the EXIF orientation must go, or
+    # viewers will rotate the image a second time.
+    return reset_exif_orientation(result.stdout)
+
+
+def reset_exif_orientation(jpeg: bytes) -> bytes:
+    """
+    Set the EXIF orientation tag of a JPEG file to 1 (upright).
+    """
+    data = bytearray(jpeg)
+
+    # Walk the JPEG segments until we find the EXIF (APP1) segment. The
+    # image data starts at the SOS marker, so stop there.
+    offset = 2
+    while offset + 4 <= len(data) and data[offset] == 0xFF:
+        marker = data[offset + 1]
+        length = struct.unpack(">H", data[offset + 2 : offset + 4])[0]
+        if marker == 0xDA:
+            break
+
+        payload = offset + 4
+        if marker == 0xE1 and data[payload : payload + 6] == b"Exif\x00\x00":
+            _reset_tiff_orientation(data, payload + 6)
+            break
+
+        offset += 2 + length
+
+    return bytes(data)
+
+
+def _reset_tiff_orientation(data: bytearray, tiff: int) -> None:
+    # The EXIF payload is a TIFF file. Its header says whether numbers
+    # are big or little endian, and where the first directory is.
+    byte_order = {b"MM": ">", b"II": "<"}.get(bytes(data[tiff : tiff + 2]))
+    if byte_order is None:
+        return
+
+    ifd = tiff + struct.unpack(byte_order + "I", data[tiff + 4 : tiff + 8])[0]
+    (entry_count,) = struct.unpack(byte_order + "H", data[ifd : ifd + 2])
+    for i in range(entry_count):
+        entry = ifd + 2 + i * 12
+        tag, field_type = struct.unpack(byte_order + "HH", data[entry : entry + 4])
+        # A SHORT value is stored in the first bytes of the value field.
+        if tag == ORIENTATION_TAG and field_type == 3:
+            data[entry + 8 : entry + 10] = struct.pack(byte_order + "H", 1)
+            return
+
+
+def upright_size(image: Any, orientation: Optional[int]) -> Tuple[int, int]:
+    """
+    Get the size of the image once it's oriented, without decoding it.
+    """
+    # Orientations 5 through 8 swap the width and height.
+    stored_w, stored_h = image.size
+    if orientation in [5, 6, 7, 8]:
+        return stored_h, stored_w
+    return stored_w, stored_h
+
+
+def draft_for_width(image: Any, width: int, upright_w: int) -> None:
+    """
+    Configure the JPEG decoder to decode at a reduced scale, as long as the
+    result is at least `width` wide once it's oriented. `upright_w` is the
+    full width of the oriented image.
+
+    This uses the DCT scaling of libjpeg, which is a lot cheaper than
+    decoding at full resolution and scaling afterwards.
+    """
+    if image.format != "JPEG" or width >= upright_w:
+        return
+
+    stored_w, stored_h = image.size
+    scale = width / upright_w
+    image.draft(image.mode, (math.ceil(stored_w * scale), math.ceil(stored_h * scale)))
+
+
+def scale_to(image: Any, size: Tuple[int, int]) -> Any:
+    """
+    Scale the image down to `size`, which comes from `state.scaled_size`,
+    so it matches the dimensions in the state.
+    """
+    width, height = size
+
+    # A Lanczos filter looks at a lot of source pixels for every output
+    # pixel, which is slow for big reductions. Shrink most of the way
+    # with a cheap box filter first. As long as we stay a few times
+    # larger than the target, the final Lanczos pass hides the
+    # difference.
+    factor = image.width // (width * REDUCING_GAP)
+    if factor >= 2:
+        image = image.resize((image.width // factor, image.height // factor), Image.BOX)
+
+    return image.resize((width, height), Image.LANCZOS)
+
+
+def get_orientation(image: Any) -> Optional[int]:
+    """
+    Get the EXIF orientation of an image, without decoding it.
     """
     exif_data = image._getexif()
     if not (exif_data):
-        return image
+        return None
+
+    orientation: Optional[int] = exif_data.get(ORIENTATION_TAG)
+    return orientation
 
-    # EXIF metadata is a binary format. The magic number below stands for
-    # the part of the metadata which all compliant software uses as the
-    # orientation tag. The parsing logic above only yields a dict from
-    # magic numbers to binary data. We need to use this number to get the
-    # orientation number, which is another magic number.
-    orientation_tag = 274
-    orientation = exif_data.get(orientation_tag)
 
+def orient_exif(image: Any) -> Any:
+    """
+    Rotate the image according to EXIF metadata.
+    """
+    orientation = get_orientation(image)
     if orientation is None:
         return image
 
@@ -3,13 +3,25 @@ from __future__ import annotations
 import json
 import sys
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from pathlib import Path
 from typing import Any, Dict, List, Optional, Tuple
 
 PXL_DIR = Path.home() / Path(".config") / Path("pxl")
 PXL_CONFIG = PXL_DIR / Path("config.json")
 
+# The number of objects that are transferred to S3 at the same time.
+# Uploads to a far-away region are bound by latency, so this is much
+# higher than the number of cores.
+DEFAULT_UPLOAD_CONCURRENCY = 16
+DEFAULT_ALBUM_PAGE_SIZE = 200
+# The widths of the scaled versions of every image. Browsers pick the
+# smallest one that fits the screen.
+DEFAULT_DERIVATIVE_WIDTHS = [1600, 1200, 800, 400]
+# The formats the scaled versions are stored in, besides JPEG. Browsers
+# that support them download a lot less.
+DEFAULT_DERIVATIVE_FORMATS = ["avif", "webp"]
+
 
 @dataclass
 class Config:
@@ -22,8 +34,30 @@ class Config:
     deploy_user: str
     deploy_path: str
     public_image_url: str
-
-    def to_json(self) -> Dict[str, str]:
+    upload_concurrency: int = DEFAULT_UPLOAD_CONCURRENCY
+    compact_state: bool = False
+    album_page_size: int = DEFAULT_ALBUM_PAGE_SIZE
+    derivative_widths: List[int] = field(
+        default_factory=lambda: list(DEFAULT_DERIVATIVE_WIDTHS)
+    )
+    derivative_formats: List[str] = field(
+        default_factory=lambda: list(DEFAULT_DERIVATIVE_FORMATS)
+    )
+    # Budgets for the quality search of the scaled JPEGs. Without either,
+    # every size gets a fixed quality.
+    jpeg_max_bytes_per_megapixel: Optional[int] = None
+    jpeg_min_psnr: Optional[float] = None
+    # Images of at least this many megapixels get a deep zoom pyramid.
+    deep_zoom_min_megapixels: Optional[float] = None
+    # Put the stylesheets in the pages, instead of linking to them.
+    inline_css: bool = False
+    # Overrides the endpoint derived from `s3_region` and `s3_endpoint`,
+    # for instance to use a local S3 server.
+    s3_endpoint_url: Optional[str] = None
+    # The bucket `pxl deploy --bucket` uploads the site to.
+    site_bucket: Optional[str] = None
+
+    def to_json(self) -> Dict[str, Any]:
         return {
             "s3_endpoint": self.s3_endpoint,
             "s3_region": self.s3_region,
@@ -34,6 +68,17 @@ class Config:
             "deploy_user": self.deploy_user,
             "deploy_path": self.deploy_path,
             "public_image_url": self.public_image_url,
+            "upload_concurrency": self.upload_concurrency,
+            "compact_state": self.compact_state,
+            "album_page_size": self.album_page_size,
+            "derivative_widths": self.derivative_widths,
+            "derivative_formats": self.derivative_formats,
+            "jpeg_max_bytes_per_megapixel": self.jpeg_max_bytes_per_megapixel,
+            "jpeg_min_psnr": self.jpeg_min_psnr,
+            "deep_zoom_min_megapixels": self.deep_zoom_min_megapixels,
+            "inline_css": self.inline_css,
+            "s3_endpoint_url": self.s3_endpoint_url,
+            "site_bucket": self.site_bucket,
         }
 
     @classmethod
@@ -48,6 +93,23 @@ class Config:
             deploy_user=json["deploy_user"],
             deploy_path=json["deploy_path"],
             public_image_url=json.get("public_image_url", ""),
+            upload_concurrency=json.get(
+                "upload_concurrency", DEFAULT_UPLOAD_CONCURRENCY
+            ),
+            compact_state=json.get("compact_state", False),
+            album_page_size=json.get("album_page_size", DEFAULT_ALBUM_PAGE_SIZE),
+            derivative_widths=json.get(
+                "derivative_widths", list(DEFAULT_DERIVATIVE_WIDTHS)
+            ),
+            derivative_formats=json.get(
+                "derivative_formats", list(DEFAULT_DERIVATIVE_FORMATS)
+            ),
+            jpeg_max_bytes_per_megapixel=json.get("jpeg_max_bytes_per_megapixel"),
+            jpeg_min_psnr=json.get("jpeg_min_psnr"),
+            deep_zoom_min_megapixels=json.get("deep_zoom_min_megapixels"),
+            inline_css=json.get("inline_css", False),
+            s3_endpoint_url=json.get("s3_endpoint_url"),
+            site_bucket=json.get("site_bucket"),
         )
 
 
@@ -64,6 +126,15 @@ def load() -> Config:
         print("Corrupted pxl config. Please fix or clean.")
         sys.exit(1)
 
+    # Booleans are ints too, but `true` is surely a mistake.
+    page_size = config.album_page_size
+    if not isinstance(page_size, int) or isinstance(page_size, bool) or page_size < 1:
+        print(
+            "album_page_size must be a whole number of at least 1, "
+            f"not {page_size!r}. Please fix."
+        )
+        sys.exit(1)
+
     return config
 
 
@@ -0,0 +1,328 @@
+"""
+Deploys of the build output that don't need rsync: delta deploys over
+SSH, and uploads to a bucket.
+
+The webserver keeps a copy of the build manifest of the last deploy, in a
+directory next to the deployed one, so it isn't published. A deploy
+compares it with the local manifest to find the files that were added,
+changed or removed, without looking at the files themselves. The added
+and changed files are sent as a single tar stream, along with the list of
+files to delete, and the new manifest comes last. It only replaces the old
+one once everything else succeeded, so if a deploy is interrupted or
+fails, the next deploy sends the same files again.
+
+Bucket deploys compare the MD5 of every file with the ETag of its object,
+which is the MD5 of its contents for objects that weren't uploaded in
+parts.
+"""
+
+from __future__ import annotations
+
+import botocore.exceptions  # type: ignore
+import hashlib
+import io
+import json
+import mimetypes
+import shlex
+import subprocess
+import posixpath
+import tarfile
+
+from dataclasses import dataclass
+from pathlib import Path, PurePosixPath
+from typing import Dict, List, Optional
+
+import pxl.config as config
+import pxl.generate as generate
+import pxl.upload as upload
+
+# The manifest of the last deploy, in the state directory on the webserver.
+REMOTE_MANIFEST_NAME = "deployed.json"
+# The files to delete, and the directories that may be left empty by that,
+# NUL separated. They're removed once the files are gone.
+DELETIONS_NAME = "deletions"
+DIRECTORIES_NAME = "directories"
+# Older versions kept their state in the deployed directory.
+LEGACY_STATE_NAMES = [".pxl-deployed.json", ".pxl-deletions"]
+
+# Bundles never change, everything else has to be checked on every visit.
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+CACHE_CONTROL = "public, max-age=0, must-revalidate"
+
+
+@dataclass
+class SiteObject:
+    """A file of the build output, the way it's stored in a bucket."""
+
+    key: str
+    # Compressible files are stored gzipped, with a `Content-Encoding`.
+    path: Path
+    content_encoding: Optional[str]
+
+    def md5(self) -> str:
+        return hashlib.md5(self.path.read_bytes()).hexdigest()
+
+
+@dataclass
+class BucketDelta:
+    upload: List[SiteObject]
+    delete: List[str]
+
+
+@dataclass
+class RemotePaths:
+    # The directory that holds the deployed directory and its state.
+    parent: str
+    # The names of the deployed directory and its state in `parent`.
+    site: str
+    state: str
+
+    @classmethod
+    def for_config(cls, cfg: config.Config) -> RemotePaths:
+        """
+        Raises `ValueError` if `deploy_path` has no parent to keep the
+        state in, like `/`.
+        """
+        parent, site = posixpath.split(posixpath.normpath(cfg.deploy_path))
+        if site in ["", ".", ".."]:
+            raise ValueError(
+                f"deploy_path {cfg.deploy_path} must name a directory in another one."
+            )
+        return cls(parent=parent or ".", site=site, state=f".{site}.pxl")
+
+
+@dataclass
+class Delta:
+    # Paths relative to the output directory.
+    upload: List[str]
+    delete: List[str]
+
+    @classmethod
+    def between(
+        cls, local: generate.Manifest, remote: Optional[generate.Manifest]
+    ) -> Delta:
+        """
+        Compute what to send to turn the `remote` manifest into `local`.
+        Without a remote manifest, or with one that was built by another
+        version of pxl, everything is sent.
+        """
+        remote_files = remote.files if remote is not None else {}
+        if remote is not None and remote.generator != local.generator:
+            upload = sorted(local.files)
+        else:
+            upload = [
+                relpath
+                for relpath, inputs_hash in sorted(local.files.items())
+                if remote_files.get(relpath) != inputs_hash
+            ]
+        delete = sorted(remote_files.keys() - local.files.keys())
+        return cls(upload=upload, delete=delete)
+
+
+def ssh_target(cfg: config.Config) -> str:
+    return f"{cfg.deploy_user}@{cfg.deploy_host}"
+
+
+def load_remote_manifest(cfg: config.Config) -> Optional[generate.Manifest]:
+    """
+    Download the manifest of the last deploy. Returns `None` if there is
+    none, for instance because the site was deployed with rsync before.
+    Raises `subprocess.CalledProcessError` if ssh fails, its errors go to
+    stderr.
+    """
+    paths = RemotePaths.for_config(cfg)
+    path = shlex.quote(f"{paths.parent}/{paths.state}/{REMOTE_MANIFEST_NAME}")
+    result = subprocess.run(
+        ["ssh", ssh_target(cfg), f"cat {path} 2>/dev/null || true"],
+        stdout=subprocess.PIPE,
+        check=True,
+    )
+    try:
+        return generate.Manifest.from_json(json.loads(result.stdout))
+    except ValueError:
+        return None
+
+
+def remote_command(paths: RemotePaths) -> str:
+    """
+    The shell command that unpacks a deploy on the webserver. Directories
+    that the deletions leave empty are removed too, like rsync's `--delete`
+    does. The new manifest is moved into place last.
+    """
+    parent = shlex.quote(paths.parent)
+    site = shlex.quote(paths.site)
+    state = shlex.quote(paths.state)
+    legacy = " ".join(f"{site}/{name}" for name in LEGACY_STATE_NAMES)
+    return (
+        f"mkdir -p {parent} && cd {parent} && mkdir -p {site} {state} && "
+        "tar -xzf - && "
+        f"xargs -0 rm -f -- < {state}/{DELETIONS_NAME} && "
+        # Directories that still have files in them stay.
+        f"{{ xargs -0 rmdir -- < {state}/{DIRECTORIES_NAME} 2>/dev/null || true; }} && "
+        f"rm -f {state}/{DELETIONS_NAME} {state}/{DIRECTORIES_NAME} {legacy} && "
+        f"mv {state}/{REMOTE_MANIFEST_NAME}.new {state}/{REMOTE_MANIFEST_NAME}"
+    )
+
+
+def emptied_directories(deleted: List[str]) -> List[str]:
+    """
+    The directories that may be empty after deleting some files, deepest
+    first, so parents come after their children.
+    """
+    directories = {
+        str(parent)
+        for relpath in deleted
+        for parent in PurePosixPath(relpath).parents
+        if str(parent) != "."
+    }
+    return sorted(directories, key=lambda directory: (-directory.count("/"), directory))
+
+
+def deploy(output_dir: Path, cfg: config.Config, delta: Delta) -> None:
+    """
+    Send the delta to the webserver as a single tar stream over SSH.
+    Raises `subprocess.CalledProcessError` if ssh or the unpacking fails.
+    """
+    paths = RemotePaths.for_config(cfg)
+
+    # The tar stream buffers by itself. Without another buffer on the pipe,
+    # closing it can't fail after ssh exited.
+    with subprocess.Popen(
+        ["ssh", ssh_target(cfg), remote_command(paths)],
+        stdin=subprocess.PIPE,
+        bufsize=0,
+    ) as ssh:
+        assert ssh.stdin is not None, "Expected a pipe to ssh"
+        try:
+            with tarfile.open(fileobj=ssh.stdin, mode="w|gz") as tar:
+                for relpath in delta.upload:
+                    arcname = f"{paths.site}/{relpath}"
+                    tar.add(str(output_dir / relpath), arcname=arcname)
+
+                deletions = "".join(
+                    f"{paths.site}/{relpath}\0" for relpath in delta.delete
+                )
+                add_bytes(tar, f"{paths.state}/{DELETIONS_NAME}", deletions.encode())
+                directories = "".join(
+                    f"{paths.site}/{directory}\0"
+                    for directory in emptied_directories(delta.delete)
+                )
+                add_bytes(
+                    tar, f"{paths.state}/{DIRECTORIES_NAME}", directories.encode()
+                )
+
+                # The manifest comes last, so it's only unpacked if
+                # everything else arrived.
+                manifest = output_dir / generate.MANIFEST_NAME
+                arcname = f"{paths.state}/{REMOTE_MANIFEST_NAME}.new"
+                tar.add(str(manifest), arcname=arcname)
+            ssh.stdin.close()
+        except BrokenPipeError:
+            # ssh exited before it read everything, its exit status says
+            # whether that was a failure.
+            pass
+
+    if ssh.returncode != 0:
+        raise subprocess.CalledProcessError(ssh.returncode, ssh.args)
+
+
+def add_bytes(tar: tarfile.TarFile, name: str, contents: bytes) -> None:
+    info = tarfile.TarInfo(name)
+    info.size = len(contents)
+    tar.addfile(info, io.BytesIO(contents))
+
+
+def site_objects(output_dir: Path, manifest: generate.Manifest) -> List[SiteObject]:
+    """
+    List the objects of the site. Buckets can't pick an encoding per
+    request, so files with a gzipped sibling are stored gzipped, and the
+    siblings aren't stored themselves.
+    """
+    objects = []
+    for relpath in sorted(manifest.files):
+        if Path(relpath).suffix in [".gz", ".br"]:
+            continue
+
+        gzipped = relpath + ".gz"
+        if gzipped in manifest.files:
+            objects.append(SiteObject(relpath, output_dir / gzipped, "gzip"))
+        else:
+            objects.append(SiteObject(relpath, output_dir / relpath, None))
+    return objects
+
+
+def bucket_delta(
+    client: upload.Client, bucket: str, objects: List[SiteObject]
+) -> BucketDelta:
+    """
+    Compare the site with the objects in the bucket. Every object in the
+    bucket that isn't part of the site is deleted.
+    """
+    etags: Dict[str, str] = {}
+    paginator = client.boto.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket):
+        for obj in page.get("Contents", []):
+            etags[obj["Key"]] = obj["ETag"].strip('"')
+
+    # Hashing is mostly I/O, so it runs on the pool as well.
+    md5s = client.pool.map(lambda obj: obj.md5(), objects)
+    changed = [obj for obj, md5 in zip(objects, md5s) if etags.get(obj.key) != md5]
+    keys = {obj.key for obj in objects}
+    return BucketDelta(
+        upload=changed, delete=sorted(key for key in etags if key not in keys)
+    )
+
+
+def deploy_to_bucket(client: upload.Client, bucket: str, delta: BucketDelta) -> None:
+    """
+    Upload the changed objects concurrently, then delete the removed ones
+    in batches. Raises `RuntimeError` if any of them couldn't be uploaded
+    or deleted. Nothing is deleted if an upload failed.
+    """
+    uploads = [
+        client.pool.submit(put_site_object, client, bucket, obj) for obj in delta.upload
+    ]
+    errors = {}
+    for obj, future in zip(delta.upload, uploads):
+        try:
+            future.result()
+        except botocore.exceptions.ClientError as e:
+            errors[obj.key] = str(e)
+    if errors:
+        raise RuntimeError(f"Couldn't upload {len(errors)} objects:\n{details(errors)}")
+
+    errors = upload.delete_objects(client, bucket, delta.delete)
+    if errors:
+        raise RuntimeError(f"Couldn't delete {len(errors)} objects:\n{details(errors)}")
+
+
+def details(errors: Dict[str, str]) -> str:
+    return "\n".join(f"{key}: {error}" for key, error in errors.items())
+
+
+def put_site_object(client: upload.Client, bucket: str, obj: SiteObject) -> None:
+    extra_args = {}
+    if obj.content_encoding is not None:
+        extra_args["ContentEncoding"] = obj.content_encoding
+
+    # A single PUT, so the ETag stays the MD5 of the contents.
+    client.boto.put_object(
+        Body=obj.path.read_bytes(),
+        Bucket=bucket,
+        Key=obj.key,
+        ACL="public-read",
+        ContentType=content_type(obj.key),
+        CacheControl=(
+            IMMUTABLE_CACHE_CONTROL if generate.is_asset(obj.key) else CACHE_CONTROL
+        ),
+        **extra_args,
+    )
+
+
+def content_type(key: str) -> str:
+    guessed, _ = mimetypes.guess_type(key)
+    if guessed is None:
+        return "application/octet-stream"
+    if guessed.startswith("text/") or guessed.endswith("javascript"):
+        return f"{guessed}; charset=utf-8"
+    return guessed
@@ -1,10 +1,371 @@
+from __future__ import annotations
+
+import concurrent.futures
+import gzip
+import hashlib
+import io
 import jinja2
+import json
+import re
 import shutil
 
+from dataclasses import dataclass
+from markupsafe import Markup
 from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
 
+import pxl.config as config
 import pxl.state as state
 
+try:
+    import brotli  # type: ignore
+except ImportError:
+    brotli = None
+
+# Records, for every output file, a hash of everything that went into it.
+# Files whose inputs didn't change aren't written again, so their mtimes
+# stay the same as well.
+MANIFEST_NAME = ".pxl-manifest.json"
+
+TEMPLATE_CACHE_DIR = config.PXL_DIR / Path("template-cache")
+
+# Outputs with these suffixes get compressed siblings, so web servers can
+# serve them without compressing every response. See `compressors`.
+PRECOMPRESSED_SUFFIXES = [".html", ".css", ".js"]
+# The stylesheets and scripts of the pages, by the name of their bundle.
+# Bundles are written under a name with a hash of their contents, so
+# browsers can cache them forever.
+ASSET_BUNDLES = {
+    "index.css": ["css/normalize.css", "css/theme.css", "css/index.css"],
+    "album.css": ["css/normalize.css", "css/theme.css", "css/album.css"],
+    "photo.css": ["css/normalize.css", "css/theme.css", "css/photo.css"],
+    "zoom.css": ["css/normalize.css", "css/theme.css", "css/zoom.css"],
+    "photo.js": ["js/photo.js"],
+    "zoom.js": ["js/zoom.js"],
+}
+ASSET_HASH_LENGTH = 12
+ASSET_PATTERN = re.compile(
+    rf"^(css|js)/[^/]+-[0-9a-f]{{{ASSET_HASH_LENGTH}}}\.(css|js)$"
+)
+
+# Files that are copied to the output as they are.
+STATIC_FILES = ["404.html"]
+
+# Brotli's highest quality is about a hundred times slower than this one
+# on our pages, and only makes them 10% smaller.
+BROTLI_QUALITY = 5
+
+
+@dataclass
+class Manifest:
+    # Maps output paths, relative to the output directory, to input hashes.
+    files: Dict[str, str]
+    # The hash of the pxl code that wrote the files, see `hash_package`.
+    generator: str
+
+    @classmethod
+    def load(cls, output_dir: Path) -> Optional[Manifest]:
+        try:
+            with (output_dir / MANIFEST_NAME).open() as f:
+                return cls.from_json(json.load(f))
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def save(self, output_dir: Path) -> None:
+        tmp_path = output_dir / (MANIFEST_NAME + ".tmp")
+        with tmp_path.open("w") as f:
+            json.dump(self.to_json(), f, sort_keys=True)
+        tmp_path.replace(output_dir / MANIFEST_NAME)
+
+    @classmethod
+    def from_json(cls, json: Dict[str, Any]) -> Optional[Manifest]:
+        try:
+            # Manifests without a generator never match the current one.
+            return cls(files=json["files"], generator=json.get("generator", ""))
+        except KeyError:
+            return None
+
+    def to_json(self) -> Dict[str, Any]:
+        return {"files": self.files, "generator": self.generator}
+
+    @classmethod
+    def empty(cls) -> Manifest:
+        return cls(files={}, generator="")
+
+
+@dataclass
+class Asset:
+    """A bundled stylesheet or script."""
+
+    # The path in the output, with a hash of the contents in the name.
+    relpath: str
+    contents: str
+
+    @property
+    def url(self) -> str:
+        return f"/{self.relpath}"
+
+    @property
+    def is_css(self) -> bool:
+        return self.relpath.endswith(".css")
+
+
+@dataclass
+class BuildResult:
+    written: int
+    unchanged: int
+    deleted: int
+
+
+@dataclass
+class Rendered:
+    """The outcome of rendering part of the site."""
+
+    # Manifest entries for the files that are part of the site.
+    files: Dict[str, str]
+    written: int
+    unchanged: int
+
+    def merge(self, other: Rendered) -> None:
+        self.files.update(other.files)
+        self.written += other.written
+        self.unchanged += other.unchanged
+
+    @classmethod
+    def empty(cls) -> Rendered:
+        return cls(files={}, written=0, unchanged=0)
+
+
+class Renderer:
+    """
+    Renders pages to the output directory, skipping the ones whose inputs
+    match the previous build.
+
+    Every worker process has its own renderer, with its own compiled
+    templates.
+    """
+
+    def __init__(
+        self,
+        output_dir: Path,
+        template_dir: Path,
+        img_baseurl: str,
+        album_page_size: int,
+        old_files: Dict[str, str],
+        assets: Dict[str, Asset],
+        inline_css: bool,
+    ) -> None:
+        self.output_dir = output_dir
+        self.img_baseurl = img_baseurl
+        self.album_page_size = album_page_size
+        self.old_files = old_files
+        self.assets = assets
+        self.inline_css = inline_css
+
+        env = load_environment(template_dir)
+        # Older versions of jinja copy the globals into every template, so
+        # these have to be set before the templates are loaded.
+        env.globals["asset_url"] = self.asset_url
+        env.globals["stylesheet"] = self.stylesheet
+        self.index_template = env.get_template("index.html.j2")
+        self.album_template = env.get_template("album.html.j2")
+        self.photo_template = env.get_template("photo.html.j2")
+        self.zoom_template = env.get_template("zoom.html.j2")
+        self.templates_hash = hash_templates(template_dir)
+        self.assets_hash = hash_assets(assets, inline_css)
+
+    def render_index(self, overview: state.Overview) -> Rendered:
+        rendered = Rendered.empty()
+        index_inputs = [
+            {
+                "name_display": album.name_display,
+                "name_nav": album.name_nav,
+                "created": album.created.isoformat(),
+                "image_count": len(album.images),
+                "cover": album.images[0].to_json() if album.images else None,
+            }
+            for album in overview.albums
+        ]
+        self.write(
+            rendered,
+            "index.html",
+            self.hash_inputs(index_inputs),
+            self.render(self.index_template, overview=overview),
+        )
+        return rendered
+
+    def render_album(self, album: state.Album) -> Rendered:
+        """Render the album pages and the pages of all its photos."""
+        rendered = Rendered.empty()
+        album_inputs = {
+            "name_display": album.name_display,
+            "name_nav": album.name_nav,
+            "created": album.created.isoformat(),
+        }
+
+        pages = paginate(album.images, self.album_page_size)
+        for page, page_images in enumerate(pages, start=1):
+            inputs = [
+                album_inputs,
+                [image.to_json() for image in page_images],
+                page,
+                len(pages),
+            ]
+            self.write(
+                rendered,
+                album_page_path(album.name_nav, page),
+                self.hash_inputs(inputs),
+                self.render(
+                    self.album_template,
+                    album=album,
+                    images=page_images,
+                    page=page,
+                    page_count=len(pages),
+                ),
+            )
+
+        for i, image in enumerate(album.images):
+            title = f"{album.name_display} - {i} / {len(album.images) - 1}"
+            img_prev = album.images[i - 1] if i - 1 >= 0 else None
+            img_next = album.images[i + 1] if i + 1 < len(album.images) else None
+            album_url = album_page_url(album.name_nav, i // self.album_page_size + 1)
+
+            inputs = [
+                image.to_json(),
+                img_prev.to_json() if img_prev else None,
+                img_next.to_json() if img_next else None,
+                album.name_nav,
+                album_url,
+                title,
+            ]
+            self.write(
+                rendered,
+                f"{album.name_nav}/{image.remote_uuid}/index.html",
+                self.hash_inputs(inputs),
+                self.render(
+                    self.photo_template,
+                    img=image,
+                    img_prev=img_prev,
+                    img_next=img_next,
+                    album_name=album.name_nav,
+                    album_url=album_url,
+                    title=title,
+                ),
+            )
+
+            if image.tile_size is not None:
+                self.render_zoom(rendered, album, image, title)
+
+        return rendered
+
+    def render_zoom(
+        self, rendered: Rendered, album: state.Album, image: state.Image, title: str
+    ) -> None:
+        """Render the deep zoom viewer of an image."""
+        photo_url = f"/{album.name_nav}/{image.remote_uuid}/"
+        inputs = [image.to_json(), photo_url, title]
+        self.write(
+            rendered,
+            f"{album.name_nav}/{image.remote_uuid}/zoom/index.html",
+            self.hash_inputs(inputs),
+            self.render(
+                self.zoom_template,
+                img=image,
+                photo_url=photo_url,
+                tile_overlap=state.TILE_OVERLAP,
+                title=title,
+            ),
+        )
+
+    def copy_static(self, template_dir: Path) -> Rendered:
+        rendered = Rendered.empty()
+        for relpath in STATIC_FILES:
+            source = template_dir / relpath
+            self.write(rendered, relpath, hash_file(source), copy(source))
+        return rendered
+
+    def write_assets(self) -> Rendered:
+        rendered = Rendered.empty()
+        for asset in self.assets.values():
+            # Inlined stylesheets aren't linked to.
+            if asset.is_css and self.inline_css:
+                continue
+
+            contents_hash = hashlib.sha256(asset.contents.encode()).hexdigest()
+            self.write(
+                rendered, asset.relpath, contents_hash, write_text(asset.contents)
+            )
+        return rendered
+
+    def asset_url(self, name: str) -> str:
+        return self.assets[name].url
+
+    def stylesheet(self, name: str) -> Markup:
+        """Link to a stylesheet bundle, or inline it."""
+        asset = self.assets[name]
+        if self.inline_css:
+            return Markup(f"<style>{asset.contents}</style>")
+        return Markup(f'<link rel="stylesheet" type="text/css" href="{asset.url}">')
+
+    def write_file(
+        self,
+        rendered: Rendered,
+        relpath: str,
+        inputs_hash: str,
+        render: Callable[[Path], None],
+    ) -> None:
+        rendered.files[relpath] = inputs_hash
+        path = self.output_dir / relpath
+        if self.old_files.get(relpath) == inputs_hash and path.exists():
+            rendered.unchanged += 1
+            return
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        render(path)
+        rendered.written += 1
+
+    def write(
+        self,
+        rendered: Rendered,
+        relpath: str,
+        inputs_hash: str,
+        render: Callable[[Path], None],
+    ) -> None:
+        """
+        Write an output file, and its compressed siblings if it has a
+        compressible suffix. The siblings are only compressed again if the
+        inputs of the file changed.
+        """
+        self.write_file(rendered, relpath, inputs_hash, render)
+        if Path(relpath).suffix not in PRECOMPRESSED_SUFFIXES:
+            return
+
+        source = self.output_dir / relpath
+        for extension, compress in compressors().items():
+            self.write_file(
+                rendered,
+                relpath + extension,
+                inputs_hash,
+                precompress(source, compress),
+            )
+
+    def render(
+        self, template: jinja2.Template, **kwargs: Any
+    ) -> Callable[[Path], None]:
+        def render_to(path: Path) -> None:
+            with path.open("w+") as f:
+                template.stream(img_baseurl=self.img_baseurl, **kwargs).dump(f)
+
+        return render_to
+
+    def hash_inputs(self, inputs: Any) -> str:
+        digest = hashlib.sha256()
+        digest.update(self.templates_hash.encode())
+        digest.update(self.assets_hash.encode())
+        digest.update(self.img_baseurl.encode())
+        digest.update(json.dumps(inputs, sort_keys=True).encode())
+        return digest.hexdigest()
+
 
 def build(
     overview: state.Overview,
@@ -12,60 +373,275 @@ def build(
     template_dir: Path,
     bucket_puburl: str,
     public_image_url: str,
-) -> None:
-    """Build a static site based on the state."""
+    album_page_size: int,
+    inline_css: bool = False,
+    jobs: int = 1,
+) -> BuildResult:
+    """Build a static site based on the state.
 
-    index_template = load_template(template_dir / "index.html.j2")
-    album_template = load_template(template_dir / "album.html.j2")
-    photo_template = load_template(template_dir / "photo.html.j2")
+    Only files whose inputs changed since the last build are written, and
+    files of albums that were removed are deleted. With more than one job,
+    albums are rendered in parallel by that many processes. Stylesheets
+    are bundled per page, and inlined with `inline_css`."""
 
-    clear_directory(output_dir)
     output_dir.mkdir(exist_ok=True)
+    old_manifest = Manifest.load(output_dir)
+    if old_manifest is None:
+        # Without a manifest we don't know which files are ours, so start
+        # from scratch.
+        clear_directory(output_dir)
+        old_manifest = Manifest.empty()
 
-    shutil.copytree(template_dir / "css", output_dir / "css")
-    shutil.copytree(template_dir / "js", output_dir / "js")
-    shutil.copy(template_dir / "404.html", output_dir / "404.html")
+    # The input hashes don't cover the code that turns the state into
+    # pages, so files written by another version of pxl are all written
+    # again. They're still ours, so they can be deleted.
+    generator = hash_package()
+    old_files = old_manifest.files if old_manifest.generator == generator else {}
 
     img_baseurl = public_image_url or bucket_puburl
+    # This compiles the templates and fills the bytecode cache before the
+    # workers start, so they only ever read from it.
+    assets = bundle_assets(template_dir)
+    renderer = Renderer(
+        output_dir,
+        template_dir,
+        img_baseurl,
+        album_page_size,
+        old_files,
+        assets,
+        inline_css,
+    )
 
-    with (output_dir / "index.html").open("w+") as f:
-        index_template.stream(overview=overview, img_baseurl=img_baseurl).dump(f)
+    rendered = renderer.copy_static(template_dir)
+    rendered.merge(renderer.write_assets())
+    rendered.merge(renderer.render_index(overview))
 
-    for album in overview.albums:
-        album_dir = output_dir / album.name_nav
-        album_dir.mkdir()
+    if jobs <= 1:
+        for album in overview.albums:
+            rendered.merge(renderer.render_album(album))
+    else:
+        # Start with the biggest albums, so a big one doesn't keep a single
+        # worker busy at the end.
+        albums = sorted(overview.albums, key=lambda album: -len(album.images))
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs,
+            initializer=_init_worker,
+            initargs=(
+                output_dir,
+                template_dir,
+                img_baseurl,
+                album_page_size,
+                old_files,
+                assets,
+                inline_css,
+            ),
+        ) as executor:
+            for album_rendered in executor.map(_render_album, albums):
+                rendered.merge(album_rendered)
 
-        with (album_dir / "index.html").open("w+") as f:
-            album_template.stream(album=album, img_baseurl=img_baseurl).dump(f)
+    deleted = old_manifest.files.keys() - rendered.files.keys()
+    for relpath in deleted:
+        remove_output(output_dir, relpath)
 
-        for i, image in enumerate(album.images):
-            image_dir = album_dir / str(image.remote_uuid)
-            image_dir.mkdir()
+    Manifest(files=rendered.files, generator=generator).save(output_dir)
+    return BuildResult(
+        written=rendered.written, unchanged=rendered.unchanged, deleted=len(deleted)
+    )
 
-            title = f"{album.name_display} - {i} / {len(album.images) - 1}"
 
-            with (image_dir / "index.html").open("w+") as f:
-                img_prev = album.images[i - 1] if i - 1 >= 0 else None
-                img_next = album.images[i + 1] if i + 1 < len(album.images) else None
+# The renderer of a worker process.
+_worker_renderer: Optional[Renderer] = None
 
-                photo_template.stream(
-                    img=image,
-                    img_prev=img_prev,
-                    img_next=img_next,
-                    img_baseurl=img_baseurl,
-                    album_name=album.name_nav,
-                    title=title,
-                ).dump(f)
+
+def _init_worker(
+    output_dir: Path,
+    template_dir: Path,
+    img_baseurl: str,
+    album_page_size: int,
+    old_files: Dict[str, str],
+    assets: Dict[str, Asset],
+    inline_css: bool,
+) -> None:
+    global _worker_renderer
+    _worker_renderer = Renderer(
+        output_dir,
+        template_dir,
+        img_baseurl,
+        album_page_size,
+        old_files,
+        assets,
+        inline_css,
+    )
+
+
+def _render_album(album: state.Album) -> Rendered:
+    assert _worker_renderer is not None, "Expected worker to be initialized"
+    return _worker_renderer.render_album(album)
+
+
+def paginate(images: List[state.Image], page_size: int) -> List[List[state.Image]]:
+    """Split the images of an album into pages. Every album has a page."""
+    pages = [images[i : i + page_size] for i in range(0, len(images), page_size)]
+    return pages or [[]]
+
+
+def album_page_path(name_nav: str, page: int) -> str:
+    if page == 1:
+        return f"{name_nav}/index.html"
+    return f"{name_nav}/page/{page}/index.html"
+
+
+def album_page_url(name_nav: str, page: int) -> str:
+    if page == 1:
+        return f"/{name_nav}/"
+    return f"/{name_nav}/page/{page}/"
+
+
+def bundle_assets(template_dir: Path) -> Dict[str, Asset]:
+    """Bundle the sources of every asset, see `ASSET_BUNDLES`."""
+    assets = {}
+    for name, sources in ASSET_BUNDLES.items():
+        contents = "\n".join((template_dir / source).read_text() for source in sources)
+        name_path = Path(name)
+        if name_path.suffix == ".css":
+            contents = minify_css(contents)
+
+        digest = hashlib.sha256(contents.encode()).hexdigest()[:ASSET_HASH_LENGTH]
+        subdir = name_path.suffix[1:]
+        relpath = f"{subdir}/{name_path.stem}-{digest}{name_path.suffix}"
+        assets[name] = Asset(relpath=relpath, contents=contents)
+    return assets
+
+
+def is_asset(relpath: str) -> bool:
+    """Whether an output is a bundle, with a hash in its name."""
+    return ASSET_PATTERN.match(relpath) is not None
+
+
+def minify_css(css: str) -> str:
+    """
+    Remove comments and whitespace that doesn't matter. This is not a full
+    CSS parser, it only has to handle our own stylesheets.
+    """
+    css = re.sub(r"/\*.*?\*/", "", css, flags=re.DOTALL)
+    css = re.sub(r"\s+", " ", css)
+    # Whitespace before a colon can separate selectors, so only the
+    # whitespace after it is removed.
+    css = re.sub(r"\s*([{};,>])\s*", r"\1", css)
+    css = re.sub(r":\s+", ":", css)
+    return css.replace(";}", "}").strip()
+
+
+def hash_assets(assets: Dict[str, Asset], inline_css: bool) -> str:
+    """Hash the bundles, so pages are rendered again when they change."""
+    digest = hashlib.sha256()
+    for name, asset in sorted(assets.items()):
+        digest.update(f"{name}:{asset.relpath}\n".encode())
+    digest.update(str(inline_css).encode())
+    return digest.hexdigest()
+
+
+def hash_templates(template_dir: Path) -> str:
+    """Hash all templates, so changing any of them rebuilds every page."""
+    digest = hashlib.sha256()
+    for path in sorted(template_dir.rglob("*.j2")):
+        digest.update(str(path.relative_to(template_dir)).encode())
+        digest.update(path.read_bytes())
+    return digest.hexdigest()
+
+
+def hash_package() -> str:
+    """Hash the source of pxl, so upgrading it rebuilds every file."""
+    digest = hashlib.sha256()
+    package_dir = Path(__file__).parent
+    for path in sorted(package_dir.glob("*.py")):
+        digest.update(path.name.encode())
+        digest.update(path.read_bytes())
+    return digest.hexdigest()
+
+
+def hash_file(path: Path) -> str:
+    return hashlib.sha256(path.read_bytes()).hexdigest()
+
+
+def write_text(contents: str) -> Callable[[Path], None]:
+    def write_to(path: Path) -> None:
+        path.write_text(contents)
+
+    return write_to
+
+
+def copy(source: Path) -> Callable[[Path], None]:
+    def copy_to(path: Path) -> None:
+        shutil.copyfile(source, path)
+
+    return copy_to
+
+
+def precompress(
+    source: Path, compress: Callable[[bytes], bytes]
+) -> Callable[[Path], None]:
+    def precompress_to(path: Path) -> None:
+        path.write_bytes(compress(source.read_bytes()))
+
+    return precompress_to
+
+
+def compressors() -> Dict[str, Callable[[bytes], bytes]]:
+    """
+    Get the compressors for the siblings of compressible outputs, by file
+    extension. Brotli is only used if it is installed.
+    """
+    result: Dict[str, Callable[[bytes], bytes]] = {".gz": gzip_compress}
+    if brotli is not None:
+        result[".br"] = brotli_compress
+    return result
+
+
+def gzip_compress(contents: bytes) -> bytes:
+    # Without a timestamp in the header, the same contents always give
+    # the same bytes.
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode="wb", compresslevel=9, mtime=0) as f:
+        f.write(contents)
+    return buffer.getvalue()
+
+
+def brotli_compress(contents: bytes) -> bytes:
+    return brotli.compress(contents, quality=BROTLI_QUALITY)  # type: ignore
+
+
+def remove_output(output_dir: Path, relpath: str) -> None:
+    """Remove an output file, and the directories it leaves empty."""
+    path = output_dir / relpath
+    try:
+        path.unlink()
+    except FileNotFoundError:
+        pass
+
+    for parent in path.relative_to(output_dir).parents:
+        if parent == Path("."):
+            break
+        try:
+            (output_dir / parent).rmdir()
+        except OSError:
+            # Not empty, so its parents aren't either.
+            break
 
 
-def load_template(template_file: Path) -> jinja2.Template:
-    """Load a jinja template from a file.
+def load_environment(template_dir: Path) -> jinja2.Environment:
+    """Create a jinja environment that loads templates from a directory.
 
-    There isn't a method in the standard API that does this, so
-    we roll it ourselves."""
+    Compiled templates are cached on disk, so later builds skip compiling
+    templates that didn't change."""
 
-    with template_file.open() as f:
-        return jinja2.Template(f.read())
+    TEMPLATE_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    env = jinja2.Environment(
+        loader=jinja2.FileSystemLoader(str(template_dir)),
+        bytecode_cache=jinja2.FileSystemBytecodeCache(str(TEMPLATE_CACHE_DIR)),
+    )
+    env.globals["album_page_url"] = album_page_url
+    return env
 
 
 def clear_directory(dir_path: Path) -> None:
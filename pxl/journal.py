@@ -0,0 +1,114 @@
+from __future__ import annotations
+
+import datetime
+import hashlib
+import json
+import os
+import threading
+
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+import pxl.config as config
+import pxl.state as state
+
+JOURNAL_DIR = config.PXL_DIR / Path("journal")
+
+
+@dataclass
+class Journal:
+    """
+    A local record of the images of an upload that made it to the bucket.
+
+    The journal is a file with one JSON object per line. The first line
+    describes the album, every other line is an uploaded image. Lines are
+    flushed to disk one by one, so a crash loses at most the line that was
+    being written.
+    """
+
+    path: Path
+    album_name: str
+    created: datetime.datetime
+    # Maps the file names in the uploaded directory to their images.
+    images: Dict[str, state.Image]
+    # Images are recorded from the threads that upload them.
+    lock: threading.Lock = field(
+        default_factory=threading.Lock, repr=False, compare=False
+    )
+
+    @classmethod
+    def start(cls, path: Path, album: state.Album) -> Journal:
+        journal = cls(
+            path=path, album_name=album.name_display, created=album.created, images={}
+        )
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with path.open("w") as f:
+            header = {
+                "album_name": album.name_display,
+                "created": album.created.isoformat(timespec="seconds"),
+            }
+            _write_line(f, header)
+        return journal
+
+    @classmethod
+    def load(cls, path: Path) -> Optional[Journal]:
+        try:
+            with path.open() as f:
+                contents = f.read()
+        except FileNotFoundError:
+            return None
+
+        # The last line may have been cut off by a crash. Remove it from the
+        # file as well, so the next record doesn't get appended to it.
+        if not contents.endswith("\n"):
+            contents = contents[: contents.rfind("\n") + 1]
+            os.truncate(path, len(contents.encode()))
+
+        lines = contents.splitlines()
+        if not lines:
+            return None
+
+        header = json.loads(lines[0])
+        images: Dict[str, state.Image] = {}
+        for line in lines[1:]:
+            entry = json.loads(line)
+            image = state.Image.from_json(entry["image"])
+            if image is not None:
+                images[entry["source"]] = image
+
+        return cls(
+            path=path,
+            album_name=header["album_name"],
+            created=datetime.datetime.fromisoformat(header["created"]),
+            images=images,
+        )
+
+    def record(self, local_filename: Path, image: state.Image) -> None:
+        """
+        Record that all sizes of `local_filename` have been uploaded.
+        """
+        with self.lock:
+            self.images[local_filename.name] = image
+            with self.path.open("a") as f:
+                line = {"source": local_filename.name, "image": image.to_json()}
+                _write_line(f, line)
+
+    def remove(self) -> None:
+        self.path.unlink()
+
+
+def path_for(cfg: config.Config, dir_path: Path) -> Path:
+    """
+    Get the journal location for uploading a directory to the configured
+    bucket. Every pair of directory and bucket gets its own journal.
+    """
+    key = f"{cfg.s3_endpoint}/{cfg.s3_bucket}:{dir_path.resolve()}"
+    digest = hashlib.sha256(key.encode()).hexdigest()[:16]
+    return JOURNAL_DIR / f"{digest}.jsonl"
+
+
+def _write_line(f: Any, obj: Dict[str, Any]) -> None:
+    f.write(json.dumps(obj) + "\n")
+    f.flush()
+    os.fsync(f.fileno())
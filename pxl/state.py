@@ -1,27 +1,36 @@
 from __future__ import annotations
 
+import base64
 import datetime
-import locale
+import functools
+import math
 import uuid
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from enum import Enum, auto
-from typing import Any, Dict, List, Optional, Tuple, TypeVar
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple, TypeVar
 
 
 class Size(Enum):
     original = auto()
     display_w_1600 = auto()
     thumbnail_w_400 = auto()
+    # The widths that can be added to the ladder of scaled versions with
+    # the `derivative_widths` setting. New sizes must be added at the end,
+    # the compact state encoding depends on the values.
+    w_320 = auto()
+    w_640 = auto()
+    w_800 = auto()
+    w_1024 = auto()
+    w_1200 = auto()
+    w_2048 = auto()
+    w_2560 = auto()
 
     @property
     def path_suffix(self) -> str:
-        res_dict = {
-            Size.original: "_o",
-            Size.display_w_1600: "_w_1600",
-            Size.thumbnail_w_400: "_w_400",
-        }
-        return res_dict[self]
+        if self == Size.original:
+            return "_o"
+        return f"_w_{self.max_width}"
 
     @property
     def max_width(self) -> int:
@@ -31,34 +40,262 @@ class Size(Enum):
             Size.original: 10_000_000,
             Size.display_w_1600: 1600,
             Size.thumbnail_w_400: 400,
+            Size.w_320: 320,
+            Size.w_640: 640,
+            Size.w_800: 800,
+            Size.w_1024: 1024,
+            Size.w_1200: 1200,
+            Size.w_2048: 2048,
+            Size.w_2560: 2560,
         }
         return size_switch[self]
 
+    @classmethod
+    def for_width(cls, width: int) -> Optional[Size]:
+        for size in cls:
+            if size != Size.original and size.max_width == width:
+                return size
+        return None
+
+
+class Format(Enum):
+    """
+    The formats the scaled versions of an image are stored in. JPEG is
+    always available, the others are smaller but not supported by every
+    browser.
+    """
+
+    jpeg = auto()
+    webp = auto()
+    avif = auto()
+
+    @property
+    def extension(self) -> str:
+        extensions = {Format.jpeg: ".jpg", Format.webp: ".webp", Format.avif: ".avif"}
+        return extensions[self]
+
+    @property
+    def content_type(self) -> str:
+        return f"image/{self.name}"
+
+
+# The order in which browsers should try the formats, best first.
+FORMAT_PREFERENCE = [Format.avif, Format.webp, Format.jpeg]
+
+# Tiles of a deep zoom pyramid share this many pixels with their
+# neighbours, so viewers don't show seams.
+TILE_OVERLAP = 1
+
+
+def scaled_size(width: int, height: int, max_width: int) -> Tuple[int, int]:
+    """
+    Get the size of the scaled version of a `width` by `height` image that
+    is at most `max_width` wide. Images are never scaled up.
+    """
+    if width <= max_width:
+        return width, height
+    return max_width, max(1, round(height * max_width / width))
+
+
+@dataclass
+class ZoomLevel:
+    """
+    A level of a deep zoom pyramid, in the Deep Zoom Image (DZI) layout.
+    Level 0 is a single pixel, and every level is twice as large as the
+    one before it, up to the full size.
+    """
+
+    level: int
+    width: int
+    height: int
+    columns: int
+    rows: int
+
+
+def zoom_levels(width: int, height: int, tile_size: int) -> List[ZoomLevel]:
+    """
+    Get the levels of the deep zoom pyramid of an image, from the full size
+    down to a single pixel.
+    """
+    max_level = math.ceil(math.log2(max(width, height, 1)))
+    levels = []
+    for level in range(max_level, -1, -1):
+        scale = 2 ** (max_level - level)
+        level_w = math.ceil(width / scale)
+        level_h = math.ceil(height / scale)
+        levels.append(
+            ZoomLevel(
+                level=level,
+                width=level_w,
+                height=level_h,
+                columns=math.ceil(level_w / tile_size),
+                rows=math.ceil(level_h / tile_size),
+            )
+        )
+    return levels
+
 
 @dataclass
 class Image:
+    # Big galleries have a lot of images in memory, so don't give every
+    # one of them a __dict__.
+    __slots__ = [
+        "remote_uuid",
+        "available_sizes",
+        "formats",
+        "content_hash",
+        "width",
+        "height",
+        "placeholder",
+        "tile_size",
+    ]
+
     # The UUID derives the remote filename for the original, detail
     # and thumbnail versions of the image.
     remote_uuid: uuid.UUID
     available_sizes: List[Size]
+    # The formats of the scaled versions. The original is always a JPEG.
+    formats: List[Format]
+    # SHA-256 of the uploaded source file, used to find duplicates.
+    # Images uploaded before we hashed them don't have one.
+    content_hash: Optional[str]
+    # Dimensions of the original, the way it is displayed. Images uploaded
+    # before we stored them don't have them.
+    width: Optional[int]
+    height: Optional[int]
+    # A tiny PNG of the image, base64 encoded. Pages show it until the
+    # image itself is loaded.
+    placeholder: Optional[str]
+    # The size of the tiles of the deep zoom pyramid, if the image has
+    # one. It is stored under `get_tiles_name`.
+    tile_size: Optional[int]
 
     @classmethod
     def from_json(cls, json: Dict[str, Any]) -> Optional[Image]:
         try:
             available_sizes = json.get("available_sizes", ["original"])
-            sizes_parsed = list(map(lambda x: Size[x], available_sizes))
+            formats = json.get("formats", ["jpeg"])
 
             return cls(
-                remote_uuid=uuid.UUID(json["remote_uuid"]), available_sizes=sizes_parsed
+                remote_uuid=uuid.UUID(json["remote_uuid"]),
+                available_sizes=[Size[size] for size in available_sizes],
+                formats=[Format[format] for format in formats],
+                content_hash=json.get("content_hash"),
+                width=json.get("width"),
+                height=json.get("height"),
+                placeholder=json.get("placeholder"),
+                tile_size=json.get("tile_size"),
             )
         except KeyError:
             return None
 
     def to_json(self) -> Dict[str, Any]:
-        return {
+        json: Dict[str, Any] = {
             "remote_uuid": self.remote_uuid.hex,
-            "available_sizes": list(map(lambda x: x.name, self.available_sizes)),
+            "available_sizes": [size.name for size in self.available_sizes],
+            "formats": [format.name for format in self.formats],
         }
+        if self.content_hash is not None:
+            json["content_hash"] = self.content_hash
+        if self.width is not None and self.height is not None:
+            json["width"] = self.width
+            json["height"] = self.height
+        if self.placeholder is not None:
+            json["placeholder"] = self.placeholder
+        if self.tile_size is not None:
+            json["tile_size"] = self.tile_size
+        return json
+
+    def placeholder_url(self) -> Optional[str]:
+        if self.placeholder is None:
+            return None
+        return f"data:image/png;base64,{self.placeholder}"
+
+    def alternate_formats(self) -> List[Format]:
+        """
+        Get the formats besides JPEG, in the order browsers should try them.
+        """
+        return [
+            format
+            for format in FORMAT_PREFERENCE
+            if format in self.formats and format != Format.jpeg
+        ]
+
+    def get_object_names(self) -> List[str]:
+        """
+        Get the names of all objects in the bucket that belong to this image.
+        """
+        object_names = []
+        for size in self.available_sizes:
+            name = self.get_name(size.name)
+            if size == Size.original:
+                object_names.append(f"{name}{Format.jpeg.extension}")
+            else:
+                object_names += [f"{name}{format.extension}" for format in self.formats]
+
+        if self.tile_size is not None and self.width and self.height:
+            tiles_name = self.get_tiles_name()
+            object_names.append(f"{tiles_name}.dzi")
+            for level in zoom_levels(self.width, self.height, self.tile_size):
+                for column in range(level.columns):
+                    for row in range(level.rows):
+                        object_names.append(
+                            f"{tiles_name}_files/{level.level}/{column}_{row}.jpg"
+                        )
+        return object_names
+
+    def get_tiles_name(self) -> str:
+        """
+        Get the name of the deep zoom pyramid. The descriptor is stored as
+        `<name>.dzi`, the tiles of every level under `<name>_files/`.
+        """
+        return f"{self.remote_uuid}_z"
+
+    def closest_size(self, width: int) -> Size:
+        """
+        Get the smallest available scaled version that is at least `width`
+        wide, or the largest one if none of them are.
+        """
+        scaled = sorted(
+            (size for size in self.available_sizes if size != Size.original),
+            key=lambda size: size.max_width,
+        )
+        for size in scaled:
+            if size.max_width >= width:
+                return size
+        return scaled[-1] if scaled else Size.original
+
+    def get_srcset(self) -> List[Tuple[str, int]]:
+        """
+        Get the name and width of every available scaled version, for a
+        `srcset` attribute. Ordered from small to large.
+        """
+        srcset: Dict[int, str] = {}
+        for size in sorted(self.available_sizes, key=lambda size: size.max_width):
+            if size == Size.original:
+                continue
+
+            dimensions = self.get_dimensions(size.name)
+            width = dimensions[0] if dimensions else size.max_width
+            # Older images have a copy of the original for every size
+            # that is wider than it.
+            srcset.setdefault(width, self.get_name(size.name))
+        return [(name, width) for width, name in srcset.items()]
+
+    def get_dimensions(self, size_name: str) -> Optional[Tuple[int, int]]:
+        """
+        Get the width and height of a size of this image, if we know them.
+        Like `get_name`, this falls back to the original for unavailable
+        sizes.
+        """
+        if self.width is None or self.height is None:
+            return None
+
+        size = Size[size_name]
+        if size not in self.available_sizes:
+            return self.width, self.height
+
+        return scaled_size(self.width, self.height, size.max_width)
 
     def get_name(self, size_name: str) -> str:
         try:
@@ -77,8 +314,13 @@ class Image:
             return Size.original.path_suffix
 
 
+MONTH_ABBREVIATIONS = "Jan Feb Mar Apr May Jun Jul Aug Sep Oct Nov Dec".split()
+
+
 @dataclass
 class Album:
+    __slots__ = ["created", "images", "name_display", "name_nav"]
+
     created: datetime.datetime
     images: List[Image]
     name_display: str
@@ -86,21 +328,11 @@ class Album:
 
     @property
     def created_human(self) -> str:
-        # We need to set the locale, because of course Python uses
-        # this kind of braindamage instead of accepting a parameter
-        # to the format function... Not thread safe of course because
-        # of the locale API. Fun read here: https://github.com/
-        # mpv-player/mpv/commit/1e70e82baa9193f6f027338b0fab0f5078971fbe
-        default_locale = locale.getlocale(locale.LC_TIME)
-        locale.setlocale(locale.LC_TIME, "en_US.UTF-8")
-
-        format_str = "%b %d, %Y"  # Ex: Jan 25, 2018
-        res = self.created.strftime(format_str)
-
-        # Set back the default locale.
-        locale.setlocale(locale.LC_TIME, default_locale)
-
-        return res
+        # Formatted by hand instead of with strftime("%b %d, %Y"), because
+        # %b depends on the process-wide locale, and switching that isn't
+        # safe while pages are rendered in parallel. Ex: Jan 25, 2018
+        month = MONTH_ABBREVIATIONS[self.created.month - 1]
+        return f"{month} {self.created.day:02}, {self.created.year}"
 
     @classmethod
     def from_json(cls, json: Any) -> Optional[Album]:
@@ -108,7 +340,12 @@ class Album:
         try:
             name_display = json["name_display"]
             name_nav = json["name_nav"]
-            images = filter_optionals([Image.from_json(img) for img in json["images"]])
+            if "images_compact" in json:
+                images = decode_images(json["images_compact"])
+            else:
+                images = filter_optionals(
+                    [Image.from_json(img) for img in json["images"]]
+                )
             return cls(
                 images=images,
                 name_display=name_display,
@@ -118,26 +355,40 @@ class Album:
         except KeyError:
             return None
 
-    def to_json(self) -> Dict[str, Any]:
-        return {
-            "images": list(map(lambda image: image.to_json(), self.images)),
+    def to_json(self, compact: bool = False) -> Dict[str, Any]:
+        json: Dict[str, Any] = {
             "name_nav": self.name_nav,
             "name_display": self.name_display,
             "created": self.created.isoformat(timespec="seconds"),
         }
+        if compact:
+            json["images_compact"] = encode_images(self.images)
+        else:
+            json["images"] = [image.to_json() for image in self.images]
+        return json
 
     def add_image(self, image: Image) -> Album:
-        return Album(
-            images=self.images + [image],
-            name_display=self.name_display,
-            created=self.created,
-            name_nav=self.name_nav,
-        )
+        """
+        Append an image to the album, in place. Returns the album.
+        """
+        self.images.append(image)
+        return self
 
 
 @dataclass
 class Overview:
-    albums: List[Album]
+    # All albums by their display name, in the order they were added.
+    # The methods below modify the overview in place and return it, so
+    # large states don't get copied for every change.
+    albums_by_name: Dict[str, Album]
+
+    @property
+    def albums(self) -> List[Album]:
+        return list(self.albums_by_name.values())
+
+    @classmethod
+    def from_albums(cls, albums: Iterable[Album]) -> Overview:
+        return cls(albums_by_name={album.name_display: album for album in albums})
 
     @classmethod
     def from_json(cls, json: Any) -> Optional[Overview]:
@@ -146,7 +397,7 @@ class Overview:
             albums = filter_optionals(
                 [Album.from_json(album) for album in json["albums"]]
             )
-            return cls(albums=albums)
+            return cls.from_albums(albums)
         except KeyError:
             return None
 
@@ -154,42 +405,376 @@ class Overview:
         return {"albums": list(map(lambda album: album.to_json(), self.albums))}
 
     def add_or_replace_album(self, new_album: Album) -> Overview:
-        albums = [
-            album
-            for album in self.albums
-            if album.name_display != new_album.name_display
-        ]
-        return Overview(albums=albums + [new_album])
+        self.albums_by_name[new_album.name_display] = new_album
+        return self
 
     def get_album_by_name(self, album_name: str) -> Optional[Album]:
-        for album in self.albums:
-            if album.name_display == album_name:
-                return album
-
-        return None
+        return self.albums_by_name.get(album_name)
 
     def edit_album(self, old_album: Album, new_album: Album) -> Overview:
-        albums = [
-            album if album.name_display != old_album.name_display else new_album
-            for album in self.albums
-        ]
-        return Overview(albums=albums)
+        self.albums_by_name = replace_in_place(
+            self.albums_by_name,
+            old_album.name_display,
+            new_album.name_display,
+            new_album,
+        )
+        return self
 
     def remove_album(self, album_to_remove: Album) -> Overview:
-        albums = [
-            album
-            for album in self.albums
-            if album.name_display != album_to_remove.name_display
-        ]
-        return Overview(albums=albums)
+        self.albums_by_name.pop(album_to_remove.name_display, None)
+        return self
 
     @classmethod
     def empty(cls) -> Overview:
-        return cls(albums=[])
+        return cls(albums_by_name={})
+
+
+@dataclass
+class AlbumEntry:
+    """
+    The summary of an album in the `Index`. The images of the album are
+    stored separately, in the shard named by `shard`.
+    """
+
+    name_display: str
+    name_nav: str
+    created: datetime.datetime
+    shard: str
+    image_count: int
+
+    @classmethod
+    def for_album(cls, album: Album, shard: Optional[str] = None) -> AlbumEntry:
+        """
+        Summarize an album. Without a shard, the album gets a new one.
+        """
+        return cls(
+            name_display=album.name_display,
+            name_nav=album.name_nav,
+            created=album.created,
+            shard=shard or uuid.uuid4().hex,
+            image_count=len(album.images),
+        )
+
+    @classmethod
+    def from_json(cls, json: Dict[str, Any]) -> Optional[AlbumEntry]:
+        try:
+            return cls(
+                name_display=json["name_display"],
+                name_nav=json["name_nav"],
+                created=datetime.datetime.fromisoformat(json["created"]),
+                shard=json["shard"],
+                image_count=json["image_count"],
+            )
+        except KeyError:
+            return None
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            "name_display": self.name_display,
+            "name_nav": self.name_nav,
+            "created": self.created.isoformat(timespec="seconds"),
+            "shard": self.shard,
+            "image_count": self.image_count,
+        }
+
+
+@dataclass
+class Index:
+    """
+    The list of all albums, without their images.
+    """
+
+    # Like `Overview`, keyed by display name and modified in place.
+    albums_by_name: Dict[str, AlbumEntry]
+
+    @property
+    def albums(self) -> List[AlbumEntry]:
+        return list(self.albums_by_name.values())
+
+    @classmethod
+    def from_albums(cls, albums: Iterable[AlbumEntry]) -> Index:
+        return cls(albums_by_name={album.name_display: album for album in albums})
+
+    @classmethod
+    def from_json(cls, json: Any) -> Optional[Index]:
+        assert isinstance(json, dict)
+        try:
+            albums = filter_optionals(
+                [AlbumEntry.from_json(album) for album in json["albums"]]
+            )
+            return cls.from_albums(albums)
+        except KeyError:
+            return None
+
+    def to_json(self) -> Dict[str, Any]:
+        return {"albums": list(map(lambda album: album.to_json(), self.albums))}
+
+    def get_album_by_name(self, album_name: str) -> Optional[AlbumEntry]:
+        return self.albums_by_name.get(album_name)
+
+    def add_or_replace_album(self, new_album: AlbumEntry) -> Index:
+        self.albums_by_name[new_album.name_display] = new_album
+        return self
+
+    def edit_album(self, old_album: AlbumEntry, new_album: AlbumEntry) -> Index:
+        self.albums_by_name = replace_in_place(
+            self.albums_by_name,
+            old_album.name_display,
+            new_album.name_display,
+            new_album,
+        )
+        return self
+
+    def remove_album(self, album_to_remove: AlbumEntry) -> Index:
+        self.albums_by_name.pop(album_to_remove.name_display, None)
+        return self
+
+    @classmethod
+    def empty(cls) -> Index:
+        return cls(albums_by_name={})
+
+
+# The content index is sharded by the first characters of the content
+# hashes, so commands only transfer the shards of the files they touch.
+CONTENT_SHARD_LENGTH = 2
+
+
+def content_shard(content_hash: str) -> str:
+    return content_hash[:CONTENT_SHARD_LENGTH]
+
+
+@dataclass
+class ContentEntry:
+    image: Image
+    # The number of places in albums that use this image.
+    refs: int
+
+
+@dataclass
+class ContentIndex:
+    """
+    All uploaded images with a content hash, by content hash.
+
+    Deduplicated images share their remote objects between albums. The
+    reference counts tell when the objects aren't used anymore.
+
+    The index is usually loaded partially, from the shards of the hashes
+    a command touches. Only these hashes may be referenced.
+    """
+
+    entries: Dict[str, ContentEntry]
+    # The shards with references that changed since they were saved.
+    changed_shards: Set[str] = field(default_factory=set, compare=False)
+
+    @classmethod
+    def from_json(cls, json: Any) -> Optional[ContentIndex]:
+        assert isinstance(json, dict)
+        try:
+            entries = {}
+            if "images_compact" in json:
+                images = decode_images(json["images_compact"])
+                for image, refs in zip(images, json["refs"]):
+                    assert image.content_hash is not None
+                    entries[image.content_hash] = ContentEntry(image=image, refs=refs)
+            else:
+                for content_hash, entry in json["images"].items():
+                    parsed = Image.from_json(entry["image"])
+                    if parsed is not None:
+                        entries[content_hash] = ContentEntry(
+                            image=parsed, refs=entry["refs"]
+                        )
+            return cls(entries=entries)
+        except KeyError:
+            return None
+
+    def to_json(self, compact: bool = False) -> Dict[str, Any]:
+        if compact:
+            entries = list(self.entries.values())
+            return {
+                "images_compact": encode_images([entry.image for entry in entries]),
+                "refs": [entry.refs for entry in entries],
+            }
+
+        return {
+            "images": {
+                content_hash: {"image": entry.image.to_json(), "refs": entry.refs}
+                for content_hash, entry in self.entries.items()
+            }
+        }
+
+    @classmethod
+    def from_overview(cls, overview: Overview) -> ContentIndex:
+        content_index = cls.empty()
+        for album in overview.albums:
+            for image in album.images:
+                content_index.add_ref(image)
+        return content_index
+
+    @classmethod
+    def from_shards(cls, shards: Iterable[ContentIndex]) -> ContentIndex:
+        return cls(
+            entries={
+                content_hash: entry
+                for shard in shards
+                for content_hash, entry in shard.entries.items()
+            }
+        )
+
+    def shard(self, shard: str) -> ContentIndex:
+        return ContentIndex(
+            entries={
+                content_hash: entry
+                for content_hash, entry in self.entries.items()
+                if content_shard(content_hash) == shard
+            }
+        )
+
+    def get(self, content_hash: str) -> Optional[Image]:
+        entry = self.entries.get(content_hash)
+        return entry.image if entry is not None else None
+
+    def add_ref(self, image: Image) -> None:
+        """
+        Record that an album uses the image.
+        """
+        if image.content_hash is None:
+            return
+
+        self.changed_shards.add(content_shard(image.content_hash))
+        entry = self.entries.get(image.content_hash)
+        if entry is None:
+            self.entries[image.content_hash] = ContentEntry(image=image, refs=1)
+        else:
+            entry.refs += 1
+
+    def remove_ref(self, image: Image) -> bool:
+        """
+        Record that an album no longer uses the image. Returns whether the
+        remote objects of the image are unused now.
+        """
+        # Images without a hash were uploaded before deduplication, they
+        # are never shared.
+        if image.content_hash is None:
+            return True
+
+        self.changed_shards.add(content_shard(image.content_hash))
+        entry = self.entries.get(image.content_hash)
+        if entry is None or entry.refs <= 1:
+            self.entries.pop(image.content_hash, None)
+            return True
+
+        entry.refs -= 1
+        return False
+
+    @classmethod
+    def empty(cls) -> ContentIndex:
+        return cls(entries={})
+
+
+# The compact encoding stores images in columns. UUIDs and content hashes
+# are concatenated as bytes and base64 encoded. Sizes are stored as a
+# bitmask, with bit `size.value - 1` set for every available size, and
+# formats likewise. This means members of `Size` and `Format` must never
+# be reordered.
+HASH_BYTES = 32
+NO_HASH = bytes(HASH_BYTES)
+
+
+def encode_images(images: List[Image]) -> Dict[str, Any]:
+    uuids = b"".join(image.remote_uuid.bytes for image in images)
+    hashes = b"".join(
+        bytes.fromhex(image.content_hash) if image.content_hash else NO_HASH
+        for image in images
+    )
+    return {
+        "uuids": base64.b64encode(uuids).decode(),
+        "sizes": [sizes_to_mask(image.available_sizes) for image in images],
+        "formats": [formats_to_mask(image.formats) for image in images],
+        "hashes": base64.b64encode(hashes).decode(),
+        # Unknown dimensions are stored as 0.
+        "widths": [image.width or 0 for image in images],
+        "heights": [image.height or 0 for image in images],
+        # Missing placeholders are stored as empty strings.
+        "placeholders": [image.placeholder or "" for image in images],
+        # Images without a deep zoom pyramid have a tile size of 0.
+        "tile_sizes": [image.tile_size or 0 for image in images],
+    }
+
+
+def decode_images(json: Dict[str, Any]) -> List[Image]:
+    uuids = base64.b64decode(json["uuids"])
+    hashes = base64.b64decode(json["hashes"])
+    widths = json.get("widths") or [0] * len(json["sizes"])
+    heights = json.get("heights") or [0] * len(json["sizes"])
+    jpeg_only = formats_to_mask([Format.jpeg])
+    formats = json.get("formats") or [jpeg_only] * len(json["sizes"])
+    placeholders = json.get("placeholders") or [""] * len(json["sizes"])
+    tile_sizes = json.get("tile_sizes") or [0] * len(json["sizes"])
+
+    images = []
+    for i, mask in enumerate(json["sizes"]):
+        content_hash = hashes[i * HASH_BYTES : (i + 1) * HASH_BYTES]
+        images.append(
+            Image(
+                remote_uuid=uuid.UUID(bytes=uuids[i * 16 : (i + 1) * 16]),
+                available_sizes=list(mask_to_sizes(mask)),
+                formats=list(mask_to_formats(formats[i])),
+                content_hash=content_hash.hex() if content_hash != NO_HASH else None,
+                width=widths[i] or None,
+                height=heights[i] or None,
+                placeholder=placeholders[i] or None,
+                tile_size=tile_sizes[i] or None,
+            )
+        )
+    return images
+
+
+def sizes_to_mask(sizes: List[Size]) -> int:
+    mask = 0
+    for size in sizes:
+        mask |= 1 << (size.value - 1)
+    return mask
+
+
+@functools.lru_cache(maxsize=None)
+def mask_to_sizes(mask: int) -> Tuple[Size, ...]:
+    return tuple(size for size in Size if mask & (1 << (size.value - 1)))
+
+
+def formats_to_mask(formats: List[Format]) -> int:
+    mask = 0
+    for format in formats:
+        mask |= 1 << (format.value - 1)
+    return mask
+
+
+@functools.lru_cache(maxsize=None)
+def mask_to_formats(mask: int) -> Tuple[Format, ...]:
+    return tuple(format for format in Format if mask & (1 << (format.value - 1)))
 
 
 T = TypeVar("T")
 
 
+def replace_in_place(
+    items: Dict[str, T], old_key: str, new_key: str, new_value: T
+) -> Dict[str, T]:
+    """
+    Replace an item of a dict with one under another key, keeping the order
+    of the dict. Another item that already has the new key is dropped. The
+    new item is added at the end if there is no item under the old key.
+    """
+    replaced = {}
+    for key, value in items.items():
+        if key == old_key:
+            replaced[new_key] = new_value
+        elif key != new_key:
+            replaced[key] = value
+
+    if old_key not in items:
+        replaced[new_key] = new_value
+    return replaced
+
+
 def filter_optionals(elems: List[Optional[T]]) -> List[T]:
     return [elem for elem in elems if elem is not None]
@@ -0,0 +1,256 @@
+"""
+Reading and writing the state in the bucket.
+
+The state is sharded, so commands only transfer the parts they touch:
+
+ - `state/index.json` lists all albums, without their images.
+ - `state/albums/<shard>.json` holds a single album, with its images.
+ - `state/content/<prefix>.json` maps content hashes that start with
+   `<prefix>` to uploaded images.
+
+Older versions of pxl kept everything in a single `state.json`. It is
+migrated the first time the index is loaded. Versions after that kept
+the content index in a single `state/content.json`, which is migrated
+the first time the content index is loaded.
+"""
+
+import json
+
+from typing import Any, Iterable, Optional
+
+import pxl.cache as cache
+import pxl.config as config
+import pxl.state as state
+import pxl.upload as upload
+
+INDEX_KEY = "state/index.json"
+LEGACY_CONTENT_KEY = "state/content.json"
+LEGACY_KEY = "state.json"
+
+
+def album_key(shard: str) -> str:
+    return f"state/albums/{shard}.json"
+
+
+def content_key(shard: str) -> str:
+    return f"state/content/{shard}.json"
+
+
+def load_index(client: upload.Client) -> state.Index:
+    """
+    Load the album index. Returns an empty index if nothing was uploaded
+    yet, and migrates a legacy `state.json` if there is one.
+    """
+    index = find_index(client)
+    return index if index is not None else state.Index.empty()
+
+
+def find_index(client: upload.Client) -> Optional[state.Index]:
+    """
+    Like `load_index`, but returns `None` if nothing was uploaded yet. An
+    index without albums is returned as is.
+    """
+    try:
+        index = state.Index.from_json(upload.get_json(client, INDEX_KEY))
+        assert index is not None, "Expected index to be valid"
+        return index
+    except client.boto.exceptions.NoSuchKey:
+        pass
+
+    try:
+        legacy_json = upload.get_json(client, LEGACY_KEY)
+    except client.boto.exceptions.NoSuchKey:
+        return None
+
+    overview = state.Overview.from_json(legacy_json)
+    assert overview is not None, "Expected state to be valid"
+    return migrate(client, overview)
+
+
+def migrate(client: upload.Client, overview: state.Overview) -> state.Index:
+    """
+    Write a legacy state in the sharded format.
+
+    The legacy `state.json` is left alone, but it isn't read anymore once
+    the index exists.
+    """
+    print(f"Migrating {LEGACY_KEY} to a sharded state...")
+
+    # The shards must exist before the index refers to them.
+    entries = [state.AlbumEntry.for_album(album) for album in overview.albums]
+    saves = [
+        client.pool.submit(save_album, client, entry, album)
+        for entry, album in zip(entries, overview.albums)
+    ]
+    for save in saves:
+        save.result()
+
+    save_content(client, state.ContentIndex.from_overview(overview))
+
+    index = state.Index.from_albums(entries)
+    save_index(client, index)
+
+    print(f"Migrated {len(entries)} albums. {LEGACY_KEY} is no longer used.")
+    return index
+
+
+def save_index(client: upload.Client, index: state.Index) -> None:
+    upload.private_json(client, json.dumps(index.to_json()), INDEX_KEY)
+
+
+def load_album(client: upload.Client, entry: state.AlbumEntry) -> state.Album:
+    album = state.Album.from_json(upload.get_json(client, album_key(entry.shard)))
+    assert album is not None, f"Expected album {entry.name_display} to be valid"
+    return album
+
+
+def save_album(
+    client: upload.Client, entry: state.AlbumEntry, album: state.Album
+) -> state.AlbumEntry:
+    """
+    Write an album to the shard of `entry`. Returns the entry, updated to
+    describe the album. It still has to be saved to the index.
+    """
+    album_json = album.to_json(compact=client.cfg.compact_state)
+    upload.private_json(client, json.dumps(album_json), album_key(entry.shard))
+    return state.AlbumEntry.for_album(album, shard=entry.shard)
+
+
+def delete_album(client: upload.Client, entry: state.AlbumEntry) -> None:
+    """
+    Remove the shard of an album. Remove it from the index first.
+    """
+    client.boto.delete_objects(
+        Delete={"Objects": [{"Key": album_key(entry.shard)}]},
+        Bucket=client.cfg.s3_bucket,
+    )
+    cache.remove(client.cfg, album_key(entry.shard))
+
+
+def load_content(
+    client: upload.Client, content_hashes: Iterable[str]
+) -> state.ContentIndex:
+    """
+    Load the shards of the content index that hold the given hashes. The
+    shards are fetched concurrently.
+    """
+    shards = sorted(
+        {state.content_shard(content_hash) for content_hash in content_hashes}
+    )
+    loaded = list(
+        client.pool.map(lambda shard: load_content_shard(client, shard), shards)
+    )
+
+    # A shard is missing until a file with its prefix is uploaded, or when
+    # the content index wasn't migrated yet.
+    if any(content is None for content in loaded):
+        migrated = migrate_content(client)
+        if migrated is not None:
+            return migrated
+
+    return state.ContentIndex.from_shards(
+        content for content in loaded if content is not None
+    )
+
+
+def load_content_shard(
+    client: upload.Client, shard: str
+) -> Optional[state.ContentIndex]:
+    try:
+        content_json = upload.get_json(client, content_key(shard))
+    except client.boto.exceptions.NoSuchKey:
+        return None
+
+    content = state.ContentIndex.from_json(content_json)
+    assert content is not None, f"Expected content index shard {shard} to be valid"
+    return content
+
+
+def migrate_content(client: upload.Client) -> Optional[state.ContentIndex]:
+    """
+    Split a legacy `state/content.json` into shards. Returns the complete
+    content index, or `None` if there is nothing to migrate.
+    """
+    try:
+        content_json = upload.get_json(client, LEGACY_CONTENT_KEY)
+    except client.boto.exceptions.NoSuchKey:
+        return None
+
+    print(f"Migrating {LEGACY_CONTENT_KEY} to a sharded content index...")
+    content = state.ContentIndex.from_json(content_json)
+    assert content is not None, "Expected content index to be valid"
+
+    content.changed_shards = {
+        state.content_shard(content_hash) for content_hash in content.entries
+    }
+    save_content(client, content)
+
+    # The shards are complete now, the legacy file would only be read again
+    # if a shard is missing.
+    client.boto.delete_objects(
+        Delete={"Objects": [{"Key": LEGACY_CONTENT_KEY}]}, Bucket=client.cfg.s3_bucket
+    )
+    cache.remove(client.cfg, LEGACY_CONTENT_KEY)
+    return content
+
+
+def save_content(client: upload.Client, content: state.ContentIndex) -> None:
+    """
+    Write the shards of the content index that changed since they were
+    loaded or last saved. The shards are written concurrently.
+    """
+
+    def save_shard(shard: str) -> None:
+        content_json = content.shard(shard).to_json(compact=client.cfg.compact_state)
+        upload.private_json(client, json.dumps(content_json), content_key(shard))
+
+    saves = [
+        client.pool.submit(save_shard, shard)
+        for shard in sorted(content.changed_shards)
+    ]
+    for save in saves:
+        save.result()
+    content.changed_shards = set()
+
+
+def load_overview(client: upload.Client) -> Optional[state.Overview]:
+    """
+    Load every album with all its images. The shards are fetched
+    concurrently. Returns `None` if nothing was uploaded yet.
+    """
+    index = find_index(client)
+    if index is None:
+        return None
+
+    albums = client.pool.map(lambda entry: load_album(client, entry), index.albums)
+    return state.Overview.from_albums(albums)
+
+
+def load_cached_overview(cfg: config.Config) -> Optional[state.Overview]:
+    """
+    Load every album from the local cache, without connecting to the
+    bucket. Returns `None` if the state isn't cached completely.
+    """
+    index_json = _load_cached_json(cfg, INDEX_KEY)
+    if index_json is None:
+        return None
+
+    index = state.Index.from_json(index_json)
+    assert index is not None, "Expected cached index to be valid"
+
+    albums = []
+    for entry in index.albums:
+        album_json = _load_cached_json(cfg, album_key(entry.shard))
+        if album_json is None:
+            return None
+
+        album = state.Album.from_json(album_json)
+        assert album is not None, f"Expected cached {entry.name_display} to be valid"
+        albums.append(album)
+
+    return state.Overview.from_albums(albums)
+
+
+def _load_cached_json(cfg: config.Config, object_name: str) -> Any:
+    cached = cache.load(cfg, object_name)
+    return upload.parse_json(cached.contents) if cached else None
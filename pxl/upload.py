@@ -1,27 +1,102 @@
 from __future__ import annotations
 
+import base64
 import boto3  # type: ignore
+import botocore.config  # type: ignore
+import botocore.exceptions  # type: ignore
+import collections
 import datetime
+import functools
 import getpass
+import gzip
+import hashlib
+import io
 import json
 import socket
 import sys
+import threading
 import uuid
 
+from boto3.s3.transfer import TransferConfig  # type: ignore
+from concurrent.futures import Future, ThreadPoolExecutor
 from contextlib import contextmanager
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Any, Dict, Iterator, Union, Optional
-
+from typing import (
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Set,
+    Tuple,
+    TypeVar,
+    Union,
+    Optional,
+)
+
+import pxl.cache as cache
 import pxl.config as config
 import pxl.compress as compress
 import pxl.state as state
 
+# Originals are the only objects that get big enough for multipart
+# uploads. Use big parts, every part costs a round trip.
+MULTIPART_THRESHOLD = 16 * 1024 * 1024
+MULTIPART_CHUNKSIZE = 16 * 1024 * 1024
+MULTIPART_CONCURRENCY = 4
+
+HASH_BLOCK_SIZE = 1024 * 1024
+
+# The most keys a single `delete_objects` request accepts.
+DELETE_BATCH_SIZE = 1000
+
+GZIP_MAGIC = b"\x1f\x8b"
+
+T = TypeVar("T")
+
+
+class TransferPool(ThreadPoolExecutor):
+    """
+    A thread pool that can drop the work that hasn't started yet. Python
+    3.9 has `shutdown(cancel_futures=True)` for this.
+    """
+
+    def __init__(self, max_workers: int) -> None:
+        super().__init__(max_workers=max_workers)
+        self.pending_lock = threading.Lock()
+        self.pending: Set[Future[Any]] = set()
+
+    def submit(  # type: ignore
+        self, fn: Callable[..., T], *args: Any, **kwargs: Any
+    ) -> Future[T]:
+        future = super().submit(fn, *args, **kwargs)
+        with self.pending_lock:
+            self.pending.add(future)
+        future.add_done_callback(self.discard)
+        return future
+
+    def discard(self, future: Future[Any]) -> None:
+        with self.pending_lock:
+            self.pending.discard(future)
+
+    def cancel_pending(self) -> None:
+        """Cancel everything that is still queued. Running work finishes."""
+        with self.pending_lock:
+            pending = list(self.pending)
+        for future in pending:
+            future.cancel()
+
 
 @dataclass
 class Client:
     boto: Any  # Boto is bad at typing.
     cfg: config.Config
+    transfer_config: Any
+    # Shared by all transfers, bounded by `cfg.upload_concurrency`.
+    pool: TransferPool
 
 
 @dataclass
@@ -55,18 +130,39 @@ class Lock:
 
 
 @contextmanager
-def client(cfg: config.Config, *, break_lock: bool = False) -> Iterator[Client]:
-    """Contextmanager for an upload client"""
-    endpoint_url = f"https://{cfg.s3_region}.{cfg.s3_endpoint}"
+def client(
+    cfg: config.Config, *, break_lock: bool = False, lock: bool = True
+) -> Iterator[Client]:
+    """
+    Contextmanager for an upload client. Unless `lock` is false, the state
+    is locked while the client is in use.
+    """
+    endpoint_url = cfg.s3_endpoint_url or f"https://{cfg.s3_region}.{cfg.s3_endpoint}"
+
+    # Every concurrent transfer needs its own connection, and multipart
+    # uploads use a few at once. Keep them all in the pool so we don't
+    # pay for a new TLS handshake per object.
+    max_connections = cfg.upload_concurrency * MULTIPART_CONCURRENCY
     boto = boto3.client(
         service_name="s3",
         aws_access_key_id=cfg.s3_key_id,
         aws_secret_access_key=cfg.s3_key_secret,
         endpoint_url=endpoint_url,
+        config=botocore.config.Config(max_pool_connections=max_connections),
     )
+    transfer_config = TransferConfig(
+        multipart_threshold=MULTIPART_THRESHOLD,
+        multipart_chunksize=MULTIPART_CHUNKSIZE,
+        max_concurrency=MULTIPART_CONCURRENCY,
+    )
+    pool = TransferPool(max_workers=cfg.upload_concurrency)
 
     placed_lock = False
     try:
+        if not lock:
+            yield Client(boto=boto, cfg=cfg, transfer_config=transfer_config, pool=pool)
+            return
+
         resp = boto.list_objects_v2(Prefix="lock.json", Bucket=cfg.s3_bucket)
         for obj in resp.get("Contents", []):
             object_data = boto.get_object(Key="lock.json", Bucket=cfg.s3_bucket)
@@ -93,64 +189,256 @@ def client(cfg: config.Config, *, break_lock: bool = False) -> Iterator[Client]:
         )
         placed_lock = True
 
-        yield Client(boto=boto, cfg=cfg)
+        yield Client(boto=boto, cfg=cfg, transfer_config=transfer_config, pool=pool)
+
+    except BaseException:
+        # After an error or Ctrl-C, don't start the queued transfers.
+        pool.cancel_pending()
+        raise
 
     finally:
+        # Let running transfers finish before we release the lock.
+        pool.shutdown(wait=True)
+
         if placed_lock:
             boto.delete_objects(
                 Delete={"Objects": [{"Key": "lock.json"}]}, Bucket=cfg.s3_bucket
             )
 
 
-def public_image_with_size(client: Client, local_filename: Path) -> state.Image:
+def public_compressed_images(
+    client: Client,
+    compressed: Iterable[Tuple[Path, compress.CompressedImage]],
+    on_uploaded: Callable[[Path, state.Image], None],
+) -> Iterator[state.Image]:
+    """
+    Upload the output of `compress.compress_images` concurrently.
+
+    `on_uploaded` is called as soon as all sizes of an image have been
+    uploaded, in whatever order that happens, on a thread of the pool.
+    Yields the uploaded images in the same order as `compressed`. An
+    image is only yielded after `on_uploaded` returned for it.
+    """
+    window = client.cfg.upload_concurrency
+    pending: Deque[Tuple[state.Image, Future[None]]] = collections.deque()
+
+    for local_filename, compressed_image in compressed:
+        image, transfers = submit_compressed_image(
+            client, local_filename, compressed_image
+        )
+        uploaded = when_done(
+            transfers, functools.partial(on_uploaded, local_filename, image)
+        )
+        pending.append((image, uploaded))
+
+        if len(pending) >= window:
+            image, uploaded = pending.popleft()
+            uploaded.result()
+            yield image
+
+    while pending:
+        image, uploaded = pending.popleft()
+        uploaded.result()
+        yield image
+
+
+def when_done(
+    transfers: List[Future[None]], callback: Callable[[], None]
+) -> Future[None]:
+    """
+    Call `callback` once all transfers succeeded. Returns a future that
+    is done after the callback returned, or failed with the error of a
+    transfer or of the callback.
+    """
+    done: Future[None] = Future()
+    remaining = len(transfers)
+    lock = threading.Lock()
+
+    def finish() -> None:
+        try:
+            for transfer in transfers:
+                transfer.result()
+            callback()
+        except Exception as e:
+            done.set_exception(e)
+        else:
+            done.set_result(None)
+
+    def transfer_done(_: Future[None]) -> None:
+        nonlocal remaining
+        with lock:
+            remaining -= 1
+            if remaining > 0:
+                return
+        finish()
+
+    if not transfers:
+        finish()
+    for transfer in transfers:
+        transfer.add_done_callback(transfer_done)
+    return done
+
+
+def submit_compressed_image(
+    client: Client, local_filename: Path, compressed: compress.CompressedImage
+) -> Tuple[state.Image, List[Future[None]]]:
+    """
+    Queue the uploads of all sizes of an image on the client's pool.
+
+    Returns the image and the transfers that have to finish before the
+    image may be put into the state.
+    """
     file_uuid = uuid.uuid4()
     extension = get_normalized_extension(local_filename)
 
-    local_scaled_files = compress.compress_image(local_filename)
-    for size, local_filename in local_scaled_files.items():
+    transfers = []
+    for size, contents in compressed.contents.items():
         object_name = f"{file_uuid}{size.path_suffix}{extension}"
-        public_image(client, local_filename, object_name)
+        print(f"Uploading {local_filename} ({size.name}) as {object_name}")
+        transfers.append(
+            client.pool.submit(
+                public_image, client, contents, object_name, state.Format.jpeg
+            )
+        )
 
-    return state.Image(
-        remote_uuid=file_uuid, available_sizes=list(local_scaled_files.keys())
+    formats = [state.Format.jpeg]
+    for (size, format), alternate in compressed.alternates.items():
+        object_name = f"{file_uuid}{size.path_suffix}{format.extension}"
+        print(
+            f"Uploading {local_filename} ({size.name}, {format.name}) as {object_name}"
+        )
+        transfers.append(
+            client.pool.submit(public_image, client, alternate, object_name, format)
+        )
+        if format not in formats:
+            formats.append(format)
+
+    image = state.Image(
+        remote_uuid=file_uuid,
+        available_sizes=list(compressed.contents.keys()),
+        formats=formats,
+        content_hash=None,
+        width=compressed.width,
+        height=compressed.height,
+        placeholder=base64.b64encode(compressed.placeholder).decode(),
+        tile_size=compressed.tile_size,
     )
 
+    if compressed.tiles:
+        tiles_name = image.get_tiles_name()
+        print(
+            f"Uploading {local_filename} (deep zoom, {len(compressed.tiles)} objects) as {tiles_name}"
+        )
+        for suffix, tile in compressed.tiles.items():
+            content_type = "application/xml" if suffix == ".dzi" else "image/jpeg"
+            transfers.append(
+                client.pool.submit(
+                    public_object, client, tile, tiles_name + suffix, content_type
+                )
+            )
+
+    return image, transfers
 
-def public_image(client: Client, local_filename: Path, object_name: str) -> None:
+
+def public_image(
+    client: Client, contents: compress.Contents, object_name: str, format: state.Format
+) -> None:
     """
-    Upload a local image as world readable with a random UUID.
+    Upload a local file or an image in memory as world readable.
     """
-    print(f"Uploading {local_filename} as {object_name}")
+    public_object(client, contents, object_name, format.content_type)
+
+
+def public_object(
+    client: Client, contents: compress.Contents, object_name: str, content_type: str
+) -> None:
     extra_args = {
-        "ContentType": "image/jpeg",
+        "ContentType": content_type,
         "ACL": "public-read",
         "ContentDisposition": "attachment",
         "CacheControl": "must-revalidate",
     }
-    client.boto.upload_file(
-        Filename=str(local_filename),
-        Bucket=client.cfg.s3_bucket,
-        ExtraArgs=extra_args,
-        Key=object_name,
-    )
+    if isinstance(contents, bytes):
+        client.boto.upload_fileobj(
+            Fileobj=io.BytesIO(contents),
+            Bucket=client.cfg.s3_bucket,
+            ExtraArgs=extra_args,
+            Key=object_name,
+            Config=client.transfer_config,
+        )
+    else:
+        client.boto.upload_file(
+            Filename=str(contents),
+            Bucket=client.cfg.s3_bucket,
+            ExtraArgs=extra_args,
+            Key=object_name,
+            Config=client.transfer_config,
+        )
+
+
+def content_hash(local_filename: Path) -> str:
+    """
+    Hash the contents of a local file, to recognize it when it's uploaded
+    again.
+    """
+    sha256 = hashlib.sha256()
+    with local_filename.open("rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
 
 
 def get_json(client: Client, object_name: str) -> Any:
-    resp = client.boto.get_object(Bucket=client.cfg.s3_bucket, Key=object_name)
+    """
+    Download and parse a JSON object. If we have a cached copy, we only
+    download the object if it changed since.
+    """
+    cached = cache.load(client.cfg, object_name)
+    conditions = {"IfNoneMatch": cached.etag} if cached else {}
+    try:
+        resp = client.boto.get_object(
+            Bucket=client.cfg.s3_bucket, Key=object_name, **conditions
+        )
+    except client.boto.exceptions.NoSuchKey:
+        cache.remove(client.cfg, object_name)
+        raise
+    except botocore.exceptions.ClientError as e:
+        if cached and e.response["Error"]["Code"] in ["304", "NotModified"]:
+            return parse_json(cached.contents)
+        raise
+
     contents = resp["Body"].read()
-    return json.loads(contents)
+    cache.save(client.cfg, object_name, resp["ETag"], contents)
+    return parse_json(contents)
 
 
 def private_json(client: Client, contents: str, object_name: str) -> None:
     """
-    Upload a local JSON file as private under a given name.
+    Upload a local JSON file as private under a given name. With the
+    `compact_state` setting, the JSON is gzipped.
     """
-    client.boto.put_object(
-        Body=contents,
+    body = contents.encode()
+    content_type = "application/json"
+    if client.cfg.compact_state:
+        body = gzip.compress(body)
+        content_type = "application/gzip"
+
+    resp = client.boto.put_object(
+        Body=body,
         Bucket=client.cfg.s3_bucket,
-        ContentType="application/json",
+        ContentType=content_type,
         Key=object_name,
     )
+    cache.save(client.cfg, object_name, resp["ETag"], body)
+
+
+def parse_json(contents: bytes) -> Any:
+    """
+    Parse JSON written by `private_json`, gzipped or not.
+    """
+    if contents[:2] == GZIP_MAGIC:
+        contents = gzip.decompress(contents)
+    return json.loads(contents)
 
 
 def get_normalized_extension(filename: Path) -> str:
@@ -162,11 +450,27 @@ def get_normalized_extension(filename: Path) -> str:
     return suffix_lowered
 
 
-def delete_image(client: Client, filename: str) -> None:
+def delete_objects(
+    client: Client, bucket: str, object_names: List[str]
+) -> Dict[str, str]:
     """
-    Delete an image from the photo hosting.
+    Delete objects in batches, concurrently on the client's pool. Returns
+    the error messages of the objects that couldn't be deleted.
     """
-    client.boto.delete_objects(
-        Delete={"Objects": [{"Key": filename + ".jpg"}]}, Bucket=client.cfg.s3_bucket
+    batches = [
+        object_names[i : i + DELETE_BATCH_SIZE]
+        for i in range(0, len(object_names), DELETE_BATCH_SIZE)
+    ]
+    responses = client.pool.map(
+        lambda batch: client.boto.delete_objects(
+            Bucket=bucket,
+            Delete={"Objects": [{"Key": name} for name in batch], "Quiet": True},
+        ),
+        batches,
     )
-    print("deleted " + filename + ".jpg")
+
+    errors = {}
+    for resp in responses:
+        for error in resp.get("Errors", []):
+            errors[error["Key"]] = f"{error['Code']}: {error['Message']}"
+    return errors
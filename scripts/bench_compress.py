@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+"""
+Compare `compress.compress_image` with the pre-pyramid implementation.
+
+Usage: pipenv run python scripts/bench_compress.py [JPEG files...]
+
+Without arguments, a synthetic 24MP JPEG is generated and used. Every
+implementation runs in a fresh process, so the peak memory use is its own.
+
+Before timing, this checks that every scaled version is as wide as its
+size, for sources that the JPEG decoder can draft to exactly that width.
+"""
+
+import concurrent.futures
+import io
+import pathlib
+import resource
+import sys
+import tempfile
+import time
+
+from typing import Any, Callable, Dict, List, Tuple
+
+sys.path.append(".")
+
+from PIL import Image  # type: ignore
+from pxl import compress, state
+
+
+def legacy_compress_image(
+    local_filename: pathlib.Path,
+) -> Dict[state.Size, pathlib.Path]:
+    """The implementation before the pyramid, kept for comparison."""
+    sizes_to_generate = [state.Size.thumbnail_w_400, state.Size.display_w_1600]
+    image_paths: Dict[state.Size, pathlib.Path] = {}
+    tempdir = pathlib.Path(tempfile.gettempdir())
+
+    with Image.open(local_filename, "r") as image:
+        image = compress.orient_exif(image)
+
+        original_tmp_path = tempdir / f"legacy-{local_filename.name}"
+        image = image.convert("RGB")
+        image.save(original_tmp_path)
+        image_paths[state.Size.original] = original_tmp_path
+
+        real_w, real_h = image.size
+        for size_to_generate in sizes_to_generate:
+            w = size_to_generate.max_width
+            scaled = image.copy()
+            size = w, real_h * (w / real_w)
+            scaled.thumbnail(size, Image.LANCZOS)
+            scaled_path = tempdir / f"legacy-{local_filename.stem}-w{w}.jpeg"
+            scaled.save(scaled_path, "JPEG")
+            image_paths[size_to_generate] = scaled_path
+
+    return image_paths
+
+
+IMPLEMENTATIONS: Dict[str, Callable[[pathlib.Path], Any]] = {
+    "legacy": legacy_compress_image,
+    "current": lambda local_filename: compress.compress_image(
+        local_filename,
+        compress.Settings(
+            sizes=[state.Size.display_w_1600, state.Size.thumbnail_w_400],
+            formats=[],
+            budget=None,
+            deep_zoom_min_pixels=None,
+        ),
+    ),
+}
+
+
+# Sources whose draft scale lands exactly on a width of the ladder.
+CHECKED_SOURCES = [(3200, 2400), (6400, 4800), (4096, 2304)]
+CHECKED_WIDTHS = [2048, 1600, 1200, 800, 400]
+
+
+def check_widths() -> None:
+    settings = compress.Settings(
+        sizes=compress.sizes_for_widths(CHECKED_WIDTHS),
+        formats=[],
+        budget=None,
+        deep_zoom_min_pixels=None,
+    )
+    for source_size in CHECKED_SOURCES:
+        path = pathlib.Path(tempfile.gettempdir()) / "pxl-check-{}x{}.jpg".format(
+            *source_size
+        )
+        Image.new("RGB", source_size, "gray").save(path)
+
+        compressed = compress.compress_image(path, settings)
+        for size, contents in compressed.contents.items():
+            if size == state.Size.original:
+                continue
+            assert isinstance(contents, bytes), f"{size.name} of {path} is a file"
+            with Image.open(io.BytesIO(contents)) as scaled:
+                expected = min(size.max_width, source_size[0])
+                assert scaled.width == expected, (
+                    f"{size.name} of {path} is {scaled.width} wide, "
+                    f"expected {expected}"
+                )
+
+
+def run(name: str, files: List[pathlib.Path]) -> Tuple[float, int]:
+    """Returns the seconds per image and the peak RSS in KiB."""
+    implementation = IMPLEMENTATIONS[name]
+    start = time.perf_counter()
+    for local_filename in files:
+        implementation(local_filename)
+    elapsed = time.perf_counter() - start
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return elapsed / len(files), peak_rss
+
+
+def synthetic_image() -> pathlib.Path:
+    path = pathlib.Path(tempfile.gettempdir()) / "pxl-bench-24mp.jpg"
+    if not path.exists():
+        image = Image.effect_mandelbrot((6000, 4000), (-2.0, -1.0, 1.0, 1.0), 100)
+        image.convert("RGB").save(path, quality=92)
+    return path
+
+
+def main() -> None:
+    files = [pathlib.Path(arg) for arg in sys.argv[1:]] or [synthetic_image()]
+
+    check_widths()
+    print("Scaled versions have the expected widths")
+
+    print(f"Compressing {len(files)} image(s)")
+    for name in IMPLEMENTATIONS:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1) as pool:
+            per_image, peak_rss = pool.submit(run, name, files).result()
+        print(
+            f"{name:>8}: {per_image * 1000:8.1f} ms/image, {peak_rss // 1024} MiB peak"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+"""
+Measure how the state model scales with the number of images.
+
+Usage: pipenv run python scripts/bench_state.py
+
+For every size, this builds an album image by image, like `pxl upload`
+does, and a state with as many albums, looking up each album by name
+before adding it. It also times a JSON round trip of the album, in the
+regular and in the compact encoding, and prints the encoded sizes. The
+list-copying `add_image` of earlier versions is timed up to 10k images,
+after that it takes minutes.
+"""
+
+import base64
+import datetime
+import gzip
+import json
+import sys
+import time
+import uuid
+
+from typing import Callable, List
+
+sys.path.append(".")
+
+from pxl import state
+
+SIZES = [1000, 10000, 100_000]
+LEGACY_MAX_SIZE = 10000
+
+
+def new_image() -> state.Image:
+    return state.Image(
+        remote_uuid=uuid.uuid4(),
+        available_sizes=[
+            state.Size.original,
+            state.Size.display_w_1600,
+            state.Size.thumbnail_w_400,
+        ],
+        formats=[state.Format.jpeg, state.Format.webp],
+        content_hash=uuid.uuid4().hex * 2,
+        width=6000,
+        height=4000,
+        placeholder=base64.b64encode(bytes(150)).decode(),
+        tile_size=None,
+    )
+
+
+def new_album(name: str) -> state.Album:
+    return state.Album(
+        created=datetime.datetime(2019, 1, 1),
+        images=[],
+        name_display=name,
+        name_nav=name,
+    )
+
+
+def legacy_add_images(images: List[state.Image]) -> None:
+    album_images: List[state.Image] = []
+    for image in images:
+        album_images = album_images + [image]
+
+
+def add_images(images: List[state.Image]) -> None:
+    album = new_album("bench")
+    for image in images:
+        album = album.add_image(image)
+
+
+def add_albums(count: int) -> None:
+    overview = state.Overview.empty()
+    for i in range(count):
+        name = f"album {i}"
+        if overview.get_album_by_name(name) is None:
+            overview = overview.add_or_replace_album(new_album(name))
+
+
+def json_round_trip(images: List[state.Image], compact: bool) -> None:
+    album = new_album("bench")
+    album.images = images
+    album_json = json.loads(json.dumps(album.to_json(compact=compact)))
+    state.Album.from_json(album_json)
+
+
+def encoded_size(images: List[state.Image], compact: bool) -> str:
+    album = new_album("bench")
+    album.images = images
+    contents = json.dumps(album.to_json(compact=compact)).encode()
+    if compact:
+        contents = gzip.compress(contents)
+    return f"{len(contents) / 1024:10.0f} KB"
+
+
+def timed(f: Callable[[], None]) -> str:
+    start = time.perf_counter()
+    f()
+    return f"{(time.perf_counter() - start) * 1000:10.1f} ms"
+
+
+def main() -> None:
+    print(
+        f"{'size':>8} {'add_image':>13} {'legacy':>13} {'albums':>13}",
+        f"{'json':>13} {'compact':>13} {'json size':>13} {'compact size':>13}",
+    )
+    for size in SIZES:
+        images = [new_image() for _ in range(size)]
+
+        legacy = "-"
+        if size <= LEGACY_MAX_SIZE:
+            legacy = timed(lambda: legacy_add_images(images))
+
+        print(
+            f"{size:>8}",
+            f"{timed(lambda: add_images(images)):>13}",
+            f"{legacy:>13}",
+            f"{timed(lambda: add_albums(size)):>13}",
+            f"{timed(lambda: json_round_trip(images, False)):>13}",
+            f"{timed(lambda: json_round_trip(images, True)):>13}",
+            f"{encoded_size(images, False):>13}",
+            f"{encoded_size(images, True):>13}",
+        )
+
+
+if __name__ == "__main__":
+    main()